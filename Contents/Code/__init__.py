@@ -1,11 +1,31 @@
 # Audnexus Agent
 # coding: utf-8
+import hashlib
 import json
 # Import internal tools
 from _version import version
+from cache_tools import (
+    fingerprint_cache,
+    negative_cache,
+    response_cache,
+    search_cache
+)
+from catalog_tools import book_catalog
+from distance_tools import levenshtein_distance
 from logging import Logging
-from search_tools import AlbumSearchTool, ArtistSearchTool, ScoreTool
-from time import sleep
+from match_tools import author_match_index, book_match_index
+from poster_tools import poster_store
+from request_tools import (
+    CircuitOpenError,
+    Task,
+    normalize_url,
+    reset_limiters,
+    run_parallel,
+    send_request,
+    single_flight
+)
+from search_tools import AlbumSearchTool, ArtistSearchTool, BatchScoreTool
+from transport_tools import HTTPStatusError
 from update_tools import AlbumUpdateTool, ArtistUpdateTool
 
 VERSION_NO = version
@@ -13,23 +33,28 @@ VERSION_NO = version
 # Score required to short-circuit matching and stop searching.
 GOOD_SCORE = 98
 
+# Preferences that change the metadata built from the same data
+FINGERPRINT_PREFS = (
+    'keep_existing_genres',
+    'simplify_title',
+    'sort_author_by_last_name',
+    'store_author_as_mood',
+)
+
 # Setup logger
 log = Logging()
 
 
 def ValidatePrefs():
     log.debug('ValidatePrefs function call')
+    # Apply changed rate limits
+    reset_limiters()
 
 
 def Start():
-    HTTP.ClearCache()
-    HTTP.CacheTime = CACHE_1WEEK
-    HTTP.Headers['User-agent'] = (
-        'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.2; Trident/4.0;'
-        'SLCC2; .NET CLR 2.0.50727; .NET CLR 3.5.30729; .NET CLR 3.0.30729;'
-        'Media Center PC 6.0'
-    )
-    HTTP.Headers['Accept-Encoding'] = 'gzip'
+    # API responses are kept in our own persistent cache,
+    # so there is no need to wipe it on every start.
+    response_cache.load()
     log.separator(
         msg=(
             "Audnexus Audiobooks Agent v" + VERSION_NO
@@ -91,6 +116,27 @@ class AudiobookArtist(Agent.Artist):
             search_helper.media.artist
         )
 
+        # Check if a book update already told us this author's ASIN
+        indexed_asin = author_match_index.get(
+            author_match_index.build_name_key(search_helper.media.artist)
+        )
+        if indexed_asin and not manual:
+            # Drop the region older entries were stored with
+            indexed_asin = indexed_asin.split('_')[0]
+            results.Append(
+                MetadataSearchResult(
+                    id=indexed_asin,
+                    lang=lang,
+                    name=search_helper.media.artist,
+                    score=100
+                )
+            )
+            log.info(
+                'Using author ASIN from a previous book update: '
+                '%s' % indexed_asin
+            )
+            return
+
         # Call search API
         result = self.call_search_api(search_helper)
 
@@ -153,9 +199,13 @@ class AudiobookArtist(Agent.Artist):
         update_helper = ArtistUpdateTool(
             'authors', force, lang, media, metadata, Prefs)
 
-        self.call_item_api(update_helper)
+        if not self.call_item_api(update_helper):
+            return
 
+        if is_unchanged(update_helper):
+            return
         self.compile_metadata(update_helper)
+        remember_update(update_helper)
 
     def call_search_api(self, helper):
         """
@@ -163,56 +213,66 @@ class AudiobookArtist(Agent.Artist):
         """
         query = helper.build_search_args()
         search_url = helper.build_url(query)
-        request = str(make_request(search_url))
-        response = json_decode(request)
+        cache_key = helper.build_cache_key()
+        # Manual searches always go to the API
+        if not helper.manual and is_known_miss(cache_key):
+            return []
+        results_list = search_cache.get(cache_key)
+        if results_list is not None:
+            log.debug('Using cached search results for: ' + cache_key)
+            return results_list
+        response = make_json_request(search_url)
         # When using asin match, put it into array
         if isinstance(response, list):
             arr_to_pass = response
         else:
             arr_to_pass = [response]
         results_list = helper.parse_api_response(arr_to_pass)
+        if results_list:
+            search_cache.set(cache_key, results_list)
+        else:
+            remember_miss(cache_key)
         return results_list
 
     def process_results(self, helper, result):
         """
             Process the results from the API call.
         """
-        # Walk the found items and gather extended information
-        info = []
-
-        log.separator(msg="Search results", log_level="info")
-        for index, result_dict in enumerate(result):
-            score_helper = ScoreTool(
-                helper,
-                index,
-                info,
-                Locale.Language.English,
-                Util.LevenshteinDistance,
-                result_dict,
-            )
-            score_helper.run_score_author()
-
-            # Print separators for easy reading
-            if index <= len(result):
-                log.separator(log_level="info")
-
-        info = sorted(info, key=lambda inf: inf['score'], reverse=True)
-        return info
+        candidates = (
+            (index, result_dict, None)
+            for index, result_dict in enumerate(result)
+        )
+        return score_candidates(helper, candidates)
 
     def call_item_api(self, helper):
         """
             Calls Audnexus API to get author details,
             then calls helper to parse those details.
+            Returns False if the author could not be found.
         """
         update_url = helper.build_url()
-        request = str(make_request(update_url))
-        response = json_decode(request)
+        if is_known_miss(helper.build_cache_key()):
+            return False
+        try:
+            response = make_json_request(
+                update_url, helper.build_cache_key(), revalidate=helper.force
+            )
+        except HTTPStatusError as err:
+            if err.status != 404:
+                raise
+            log.warn('Item not found: ' + update_url)
+            remember_miss(helper.build_cache_key())
+            return False
+        helper.fingerprint = build_fingerprint(helper, response)
         helper.parse_api_response(response)
+        return True
 
     def compile_metadata(self, helper):
         """
             Compiles the metadata for the artist.
         """
+        # Fetch the poster while the rest is set
+        poster_task = Task(fetch_poster, helper)
         # Description.
         helper.set_metadata_description()
         # Tags.
@@ -223,11 +283,11 @@ class AudiobookArtist(Agent.Artist):
         helper.set_metadata_sort_title()
         # Thumb.
         # Kept here because of Proxy
-        if helper.thumb:
-            if helper.thumb not in helper.metadata.posters or helper.force:
-                helper.metadata.posters[helper.thumb] = Proxy.Media(
-                    make_request(helper.thumb), sort_order=0
-                )
+        poster = poster_task.result()
+        if poster:
+            helper.metadata.posters[helper.thumb] = Proxy.Media(
+                poster, sort_order=0
+            )
 
         helper.log_update_metadata()
 
@@ -277,28 +337,71 @@ class AudiobookAlbum(Agent.Album):
                 'Using quick match based on asin: '
                 '%s' % quick_match_asin
             )
+            # Remember the match for copies without an ASIN
+            search_helper.validate_author_name()
+            book_match_index.add(
+                search_helper.build_match_key(), quick_match_asin
+            )
             return
 
         # # Validate author name
         search_helper.validate_author_name()
 
-        # Call search API
-        result = self.call_search_api(search_helper)
+        # Check if this book was matched before
+        match_key = search_helper.build_match_key()
+        indexed_asin = book_match_index.get(match_key)
+        if indexed_asin and not manual:
+            results.Append(
+                MetadataSearchResult(
+                    id=indexed_asin,
+                    lang=lang,
+                    name=indexed_asin,
+                    score=100,
+                    year=1969
+                )
+            )
+            log.info(
+                'Using previous match from local index: '
+                '%s' % indexed_asin
+            )
+            return
 
-        # Write search result status to log
-        if not result:
-            log.warn(
-                'No results found for query "%s"',
+        # Try books seen in earlier searches before the API
+        info = None
+        if not manual:
+            info = self.search_catalog(search_helper)
+
+        if not info:
+            # Call search API
+            result = self.call_search_api(search_helper)
+
+            # Write search result status to log
+            if not result:
+                log.warn(
+                    'No results found for query "%s"',
+                    search_helper.normalizedName
+                )
+                return
+            log.debug(
+                'Found %s result(s) for query "%s"',
+                len(result),
                 search_helper.normalizedName
             )
-            return
-        log.debug(
-            'Found %s result(s) for query "%s"',
-            len(result),
-            search_helper.normalizedName
-        )
 
-        info = self.process_results(search_helper, result)
+            info = self.process_results(search_helper, result)
+            info = self.search_more_pages(search_helper, result, info)
+        # Index the result Plex goes on to update for this media.
+        # Automatic matches use the top result, if it is good enough.
+        if manual and info:
+            book_match_index.propose(
+                match_key,
+                [r['id'] for r in info],
+                search_helper.media.title
+            )
+        elif info and info[0]['score'] >= GOOD_SCORE:
+            book_match_index.propose(
+                match_key, [info[0]['id']], search_helper.media.album
+            )
 
         # Nested dict for localized separators
         # 'T_A' is the separator between title and author
@@ -376,30 +479,163 @@ class AudiobookAlbum(Agent.Album):
         update_helper = AlbumUpdateTool(
             'books', force, lang, media, metadata, Prefs)
 
-        self.call_item_api(update_helper)
+        if not self.call_item_api(update_helper):
+            return
 
+        # The match was accepted, add it to the local index
+        book_match_index.confirm(metadata.id, media.title)
+        remember_authors(update_helper)
+
+        if is_unchanged(update_helper):
+            return
         self.compile_metadata(update_helper)
+        remember_update(update_helper)
 
-    def call_search_api(self, helper):
+    def call_search_api(self, helper, page=1):
         """
             Builds URL then calls API, returns the JSON to helper function.
         """
+        helper.page = page
         query = helper.build_search_args()
         search_url = helper.build_url(query)
-        request = str(make_request(search_url))
-        response = json_decode(request)
-        results_list = helper.parse_api_response(response)
+        cache_key = helper.build_cache_key()
+        # Manual searches always go to the API
+        if not helper.manual and is_known_miss(cache_key):
+            return []
+        results_list = search_cache.get(cache_key)
+        if results_list is not None:
+            log.debug('Using cached search results for: ' + cache_key)
+            return results_list
+        complete = True
+        if len(helper.search_regions) > 1:
+            results_list, complete = self.call_multi_region_search_api(helper)
+        else:
+            response = make_json_request(search_url)
+            results_list = helper.parse_api_response(response)
+        if not complete:
+            # Don't remember results missing the failed regions
+            book_catalog.add(results_list)
+            return results_list
+        if results_list:
+            search_cache.set(cache_key, results_list)
+            book_catalog.add(results_list)
+        else:
+            remember_miss(cache_key)
         return results_list
 
-    def process_results(self, helper, result):
+    def search_catalog(self, helper):
+        """
+            Scores similar books from the local catalog.
+            Returns the ranked results only if the best one is
+            good enough to skip calling the search API.
+        """
+        helper.build_url(helper.build_search_args())
+        candidates = book_catalog.search(
+            helper.normalizedName, helper.media.artist, helper.search_regions
+        )
+        if not candidates:
+            return None
+        log.debug(
+            'Found %s candidate(s) in local catalog', len(candidates)
+        )
+
+        info = self.process_results(helper, candidates)
+        if info and info[0]['score'] >= GOOD_SCORE:
+            log.info('Using match from local catalog')
+            return info
+        return None
+
+    def call_multi_region_search_api(self, helper):
+        """
+            Searches all of the helper's regions at the same time,
+            then merges the results into a single list.
+            Returns the merged list, and whether every region answered.
+            Raises the first error if all of the regions failed.
+        """
+        def search_region(region):
+            search_url = helper.build_region_url(region)
+            helper.log_search_url(search_url)
+            try:
+                response = make_json_request(search_url)
+            except Exception as err:
+                log.error('Search failed for region %s: %s', region, err)
+                return err
+            return helper.parse_api_response(response, region)
+
+        region_results = run_parallel(search_region, helper.search_regions)
+        errors = [
+            result for result in region_results
+            if isinstance(result, Exception)
+        ]
+        if len(errors) == len(region_results):
+            raise errors[0]
+        merged = helper.merge_region_results(
+            [
+                result for result in region_results
+                if not isinstance(result, Exception)
+            ]
+        )
+        return merged, not errors
+
+    def search_more_pages(self, helper, result, info):
+        """
+            With adaptive paging, fetches and scores further pages
+            of search results while none of them is good enough.
+            Returns all kept results, ranked by score.
+        """
+        if not helper.uses_adaptive_paging():
+            return info
+        offset = len(result)
+        page_results = result
+        # Results are scored lower the further down they are,
+        # so later pages can't beat a result scoring at least this
+        while (
+            len(page_results) >= helper.ADAPTIVE_PAGE_SIZE and
+            helper.page < helper.ADAPTIVE_MAX_PAGES and
+            not (
+                info and
+                info[0]['score'] >= BatchScoreTool.INITIAL_SCORE - offset
+            )
+        ):
+            page_results = self.call_search_api(helper, helper.page + 1)
+            if not page_results:
+                break
+            log.debug('Scoring page %s of search results', helper.page)
+            # Continue the result index, so positions are scored as before
+            info = self.merge_scored_results(
+                info + self.process_results(helper, page_results, offset)
+            )
+            offset += len(page_results)
+        return info
+
+    def merge_scored_results(self, info):
+        """
+            Ranks results from several pages by score.
+            A result can show up on two pages if the ranking shifted
+            between requests, only its best score is kept.
+        """
+        merged = []
+        seen_ids = set()
+        for result in sorted(info, key=lambda inf: inf['score'], reverse=True):
+            if result['id'] not in seen_ids:
+                seen_ids.add(result['id'])
+                merged.append(result)
+        return merged
+
+    def process_results(self, helper, result, offset=0):
         """
             Process the results from the API call.
         """
-        # Walk the found items and gather extended information
-        info = []
+        return score_candidates(
+            helper, self.iter_candidates(helper, result, offset)
+        )
 
-        log.separator(msg="Search results", log_level="info")
-        for index, result_dict in enumerate(result):
+    def iter_candidates(self, helper, result, offset=0):
+        """
+            Yields the results worth scoring, with their release year.
+            Dates are only parsed as results are consumed.
+        """
+        for index, result_dict in enumerate(result, offset):
             date = self.getDateFromString(result_dict['date'])
             year = ''
             if date is not None:
@@ -409,41 +645,40 @@ class AudiobookAlbum(Agent.Album):
                 if helper.check_if_preorder(date):
                     continue
 
-            score_helper = ScoreTool(
-                helper,
-                index,
-                info,
-                Locale.Language.English,
-                Util.LevenshteinDistance,
-                result_dict,
-                year
-            )
-            score_helper.run_score_book()
-
-            # Print separators for easy reading
-            if index <= len(result):
-                log.separator(log_level="info")
-
-        info = sorted(info, key=lambda inf: inf['score'], reverse=True)
-        return info
+            yield index, result_dict, year
 
     def call_item_api(self, helper):
         """
             Calls Audnexus API to get book details,
             then calls helper to parse those details.
+            Returns False if the book could not be found.
         """
         update_url = helper.build_url()
-        request = str(make_request(update_url))
-        response = json_decode(request)
+        if is_known_miss(helper.build_cache_key()):
+            return False
+        try:
+            response = make_json_request(
+                update_url, helper.build_cache_key(), revalidate=helper.force
+            )
+        except HTTPStatusError as err:
+            if err.status != 404:
+                raise
+            log.warn('Item not found: ' + update_url)
+            remember_miss(helper.build_cache_key())
+            return False
+        helper.fingerprint = build_fingerprint(helper, response)
         helper.parse_api_response(response)
 
         # Set date to date object
         helper.date = self.getDateFromString(helper.date)
+        return True
 
     def compile_metadata(self, helper):
         """
             Compiles the metadata for the book.
         """
+        # Fetch the poster while the rest is set
+        poster_task = Task(fetch_poster, helper)
         # Date.
         helper.set_metadata_date()
         # Tags.
@@ -458,13 +693,13 @@ class AudiobookAlbum(Agent.Album):
         helper.set_metadata_summary()
         # Thumb.
         # Kept here because of Proxy
-        if helper.thumb:
-            if helper.thumb not in helper.metadata.posters or helper.force:
-                helper.metadata.posters[helper.thumb] = Proxy.Media(
-                    make_request(helper.thumb), sort_order=0
-                )
-                # Re-prioritize the poster to the first position
-                helper.metadata.posters.validate_keys([helper.thumb])
+        poster = poster_task.result()
+        if poster:
+            helper.metadata.posters[helper.thumb] = Proxy.Media(
+                poster, sort_order=0
+            )
+            # Re-prioritize the poster to the first position
+            helper.metadata.posters.validate_keys([helper.thumb])
         # Rating.
         helper.set_metadata_rating()
 
@@ -495,28 +730,242 @@ def json_decode(output):
         return None
 
 
-def make_request(url):
+def score_candidates(helper, candidates):
     """
-        Makes and returns an HTTP request.
-        Retries 4 times, increasing  time between each retry.
+        Scores search results, returning the kept ones ranked by score.
+        Manual searches score every result in one batch,
+        automatic searches stop once a result is good enough.
     """
-    sleep_time = 1
-    num_retries = 4
-    for x in range(0, num_retries):
-        try:
-            make_request = HTTP.Request(url, timeout=90, sleep=sleep_time)
-            str_error = None
-            ssl_error = None
-        except Exception as str_error:
-            log.error("Failed http request attempt #" + x + ": " + url)
-            log.error(str_error)
-        except SSLError as ssl_error:
-            log.error("Failed http request attempt #" + x + ": " + url)
-            log.error(ssl_error)
-
-        if str_error or ssl_error:
-            sleep(sleep_time)
-            sleep_time *= x
-        else:
+    score_helper = BatchScoreTool(
+        helper,
+        Locale.Language.English,
+        levenshtein_distance
+    )
+
+    log.separator(msg="Search results", log_level="info")
+    if helper.manual:
+        return score_helper.score_all(candidates)
+
+    for scored in score_helper.iter_scores(candidates):
+        if is_good_score(helper, scored):
             break
-    return make_request
+    return sorted(
+        score_helper.info, key=lambda inf: inf['score'], reverse=True
+    )
+
+
+def is_good_score(helper, scored):
+    """
+        Checks if an automatic search can stop at this result.
+    """
+    if not helper.manual and scored['score'] >= GOOD_SCORE:
+        log.info(
+            'Result scored at least %s, skipping the remaining results',
+            GOOD_SCORE
+        )
+        return True
+    return False
+
+
+def is_known_miss(cache_key):
+    """
+        Checks if a search or item recently came up empty.
+    """
+    if negative_cache.get(cache_key):
+        log.info('Skipping request which recently found nothing: ' + cache_key)
+        return True
+    return False
+
+
+def remember_miss(cache_key):
+    """
+        Remembers that a search or item came up empty.
+    """
+    negative_cache.set(cache_key, True)
+
+
+def build_fingerprint(helper, response):
+    """
+        Returns a hash of everything an update is built from:
+        the API response, language, relevant preferences and agent version.
+    """
+    payload = json.dumps(
+        [
+            VERSION_NO,
+            helper.lang,
+            [Prefs[pref_id] for pref_id in FINGERPRINT_PREFS],
+            response,
+        ],
+        sort_keys=True
+    )
+    return hashlib.sha1(payload).hexdigest()
+
+
+def is_unchanged(helper):
+    """
+        Checks if the item was last updated from the same data,
+        and its metadata is still intact, so it can be left as is.
+        A forced refresh is only skipped after another forced update,
+        as normal updates leave some existing fields alone.
+    """
+    previous = fingerprint_cache.get(helper.metadata.id)
+    if (
+        previous and
+        previous['fingerprint'] == helper.fingerprint and
+        (previous.get('force') or not helper.force) and
+        helper.is_metadata_intact(previous)
+    ):
+        log.info('Nothing changed since the last update, skipping it')
+        return True
+    return False
+
+
+def remember_update(helper):
+    """
+        Stores the fingerprint of an applied update.
+    """
+    fingerprint_cache.set(
+        helper.metadata.id,
+        {
+            'fingerprint': helper.fingerprint,
+            'force': helper.force,
+            'tags': helper.get_tag_snapshot(),
+            'thumb': helper.thumb,
+        }
+    )
+
+
+def remember_authors(helper):
+    """
+        Indexes the ASINs of a book's authors by name,
+        so artist searches can find them without the API.
+    """
+    for author in getattr(helper, 'author', None) or []:
+        if author.get('asin') and author.get('name'):
+            # Stored without the book's region, like API search results,
+            # so the author update uses the preferred region
+            author_match_index.add(
+                author_match_index.build_name_key(author['name']),
+                author['asin']
+            )
+
+
+def make_json_request(url, cache_key=None, revalidate=False):
+    """
+        Makes an HTTP request and returns the decoded JSON.
+        Concurrent calls for the same URL and options
+        share one request and decode.
+    """
+    return single_flight.do(
+        build_flight_key('json', url, cache_key, revalidate),
+        lambda: json_decode(make_request(url, cache_key, revalidate))
+    )
+
+
+def fetch_poster(helper):
+    """
+        Resolves the poster URL and returns its image,
+        or None if the item already has that poster.
+        Runs in the background during updates, so it only reads metadata.
+    """
+    helper.resolve_thumb()
+    if not helper.thumb:
+        return None
+    if helper.thumb in helper.metadata.posters and not helper.force:
+        return None
+    return get_poster(helper.thumb)
+
+
+def get_poster(url):
+    """
+        Returns the image for a poster URL,
+        from the local poster store when it has it.
+    """
+    image = poster_store.get(url)
+    if image is None:
+        image = make_request(url)
+        poster_store.add(url, image)
+    return image
+
+
+def make_request(url, cache_key=None, revalidate=False):
+    """
+        Makes an HTTP request and returns the response body.
+        Concurrent calls for the same URL share one request,
+        as long as they also share the cache key and revalidation,
+        so a forced refresh never gets an unrevalidated response.
+    """
+    return single_flight.do(
+        build_flight_key('raw', url, cache_key, revalidate),
+        fetch, url, cache_key, revalidate
+    )
+
+
+def build_flight_key(kind, url, cache_key, revalidate):
+    """
+        Builds the key under which identical concurrent requests
+        are coalesced.
+    """
+    return ' '.join([
+        kind,
+        'revalidate' if revalidate else 'cached',
+        cache_key or '-',
+        normalize_url(url),
+    ])
+
+
+def fetch(url, cache_key=None, revalidate=False):
+    """
+        Makes an HTTP request through the shared keep-alive transport,
+        and returns the response body.
+        Failed requests are retried with backoff, see send_request.
+        If a cache key is passed, the response is served from
+        and stored in the persistent response cache.
+        Expired entries, or any entry when revalidate is set,
+        are revalidated with a conditional request first.
+    """
+    headers = {}
+    cached = None
+    if cache_key:
+        cached = response_cache.get_entry(cache_key, allow_stale=True)
+        if cached and not revalidate and not cached['stale']:
+            log.debug('Using cached response for: ' + cache_key)
+            return cached['value']
+        if cached:
+            headers = build_conditional_headers(cached)
+
+    try:
+        response = send_request(url, headers=headers)
+    except CircuitOpenError:
+        if not cached:
+            raise
+        # Host is down, an outdated response beats no response
+        log.warn('Using outdated cached response for: ' + cache_key)
+        return cached['value']
+
+    if cached and response.status == 304:
+        log.debug('Cached response is still valid for: ' + cache_key)
+        response_cache.refresh(cache_key)
+        return cached['value']
+
+    if cache_key:
+        response_cache.set(
+            cache_key,
+            response.content,
+            etag=response.header('etag'),
+            last_modified=response.header('last-modified')
+        )
+    return response.content
+
+
+def build_conditional_headers(cached):
+    """
+        Builds the headers to revalidate a cached response,
+        from the validators stored with it.
+    """
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    return headers
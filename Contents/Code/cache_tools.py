@@ -0,0 +1,370 @@
+import hashlib
+import threading
+import time
+# Import internal tools
+from logging import Logging
+
+# Setup logger
+log = Logging()
+
+# Common cache lifetimes, in seconds
+CACHE_HOUR = 60 * 60
+CACHE_DAY = 24 * CACHE_HOUR
+CACHE_WEEK = 7 * CACHE_DAY
+
+
+class CacheTool:
+    """
+        Persistent key/value cache stored in the plugin's Data folder.
+        Each entry has its own expiry, and the least recently used entries
+        are evicted once the cache grows beyond its size budget.
+
+        Parameters
+        ----------
+        namespace : str
+            Unique name of the cache, used to prefix stored files.
+        ttl : int
+            Default lifetime of an entry, in seconds.
+        max_size : int
+            Size budget of the cache, in bytes.
+            None keeps every entry until it expires.
+        inline : bool, optional
+            Store values inside the index instead of one file per entry.
+            Meant for small values, as every flush rewrites the whole index.
+            Other caches store strings as is and anything else as an object.
+        stale_ttl : int, optional
+            How long expired entries are kept around so they can be
+            revalidated, in seconds.
+        save_every : int, optional
+            Number of writes before the index is flushed to disk.
+        save_interval : int, optional
+            Maximum number of seconds between index flushes.
+    """
+    # Number of writes before the index is flushed to disk
+    SAVE_EVERY = 25
+    # Maximum number of seconds between index flushes
+    SAVE_INTERVAL = 60
+    # Fraction of the size budget to shrink to when evicting
+    EVICT_TO = 0.9
+
+    def __init__(
+        self,
+        namespace,
+        ttl,
+        max_size,
+        inline=False,
+        stale_ttl=0,
+        save_every=SAVE_EVERY,
+        save_interval=SAVE_INTERVAL
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_size = max_size
+        self.inline = inline
+        self.stale_ttl = stale_ttl
+        self.entries = None
+        self.lock = threading.RLock()
+        # Held while flushing, so flushes are written in order
+        self.save_lock = threading.Lock()
+        self.last_save = time.time()
+        self.save_every = save_every
+        self.save_interval = save_interval
+        # Payloads waiting for the index to be saved, keyed by cache key
+        self.pending = {}
+        self.total_size = 0
+        self.unsaved = 0
+
+    def get(self, key):
+        """
+            Returns the cached value for a key,
+            or None if it is missing or expired.
+        """
+        entry = self.get_entry(key)
+        if entry:
+            return entry['value']
+
+    def get_entry(self, key, allow_stale=False):
+        """
+            Returns the cached entry for a key, including its value.
+            Expired entries are only returned if allow_stale is set.
+        """
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if entry['expires'] < time.time() and not allow_stale:
+                return None
+
+            if self.inline:
+                value = entry.get('value')
+            elif key in self.pending:
+                value = self.pending[key]
+            elif entry.get('pickled'):
+                value = Data.LoadObject(self.get_file_name(key))
+            else:
+                value = Data.Load(self.get_file_name(key))
+            if value is None:
+                # Payload went missing from disk
+                self.remove(key)
+                return None
+
+            entry['accessed'] = time.time()
+            result = dict(entry)
+            result['stale'] = entry['expires'] < time.time()
+            result['value'] = value
+            return result
+
+    def get_file_name(self, key):
+        """
+            Returns the Data file name holding the payload for a key.
+        """
+        return 'cache_' + self.namespace + '_' + hashlib.sha1(
+            key.encode('utf-8') if isinstance(key, unicode) else key
+        ).hexdigest()
+
+    def get_index_name(self):
+        """
+            Returns the Data file name holding the cache index.
+        """
+        return 'cache_' + self.namespace + '_index'
+
+    def estimate_size(self, value):
+        """
+            Returns the approximate size of a value, in bytes.
+        """
+        if isinstance(value, basestring):
+            return len(value)
+        # Good enough for the small objects stored inline
+        return len(repr(value))
+
+    def evict(self):
+        """
+            Removes least recently used entries until
+            the cache fits its size budget again.
+        """
+        if self.max_size is None or self.total_size <= self.max_size:
+            return
+        target = self.max_size * self.EVICT_TO
+        by_access = sorted(
+            self.entries.keys(), key=lambda k: self.entries[k]['accessed']
+        )
+        evicted = 0
+        for key in by_access:
+            if self.total_size <= target:
+                break
+            self.remove(key)
+            evicted += 1
+        log.debug(
+            'Evicted %s entries from %s cache', evicted, self.namespace
+        )
+
+    def has(self, key):
+        """
+            Checks if an unexpired entry exists for a key,
+            without loading its payload.
+        """
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            return bool(entry) and entry['expires'] >= time.time()
+
+    def items(self):
+        """
+            Returns (key, value) pairs for all unexpired entries.
+            Only supported for inline caches.
+        """
+        with self.lock:
+            self.load()
+            now = time.time()
+            return [
+                (key, entry['value'])
+                for key, entry in self.entries.items()
+                if entry['expires'] >= now
+            ]
+
+    def load(self):
+        """
+            Loads the cache index from disk, once.
+            Drops entries which have expired.
+        """
+        with self.lock:
+            if self.entries is not None:
+                return
+            try:
+                self.entries = Data.LoadObject(self.get_index_name()) or {}
+            except Exception as e:
+                log.error(
+                    'Could not load %s cache, starting empty: %s',
+                    self.namespace, e
+                )
+                self.entries = {}
+            # Builtin sum() isn't available in the plugin sandbox
+            self.total_size = reduce(
+                lambda total, entry: total + entry['size'],
+                self.entries.values(),
+                0
+            )
+            self.prune()
+            log.debug(
+                'Loaded %s cache with %s entries',
+                self.namespace, len(self.entries)
+            )
+
+    def prune(self):
+        """
+            Removes all expired entries,
+            once they are past the time kept for revalidation.
+            The index is saved with the next write.
+        """
+        with self.lock:
+            self.load()
+            now = time.time() - self.stale_ttl
+            expired = [
+                key for key, entry in self.entries.items()
+                if entry['expires'] < now
+            ]
+            for key in expired:
+                self.remove(key)
+
+    def refresh(self, key, ttl=None):
+        """
+            Extends the lifetime of an entry without rewriting its value.
+        """
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if not entry:
+                return
+            now = time.time()
+            entry['accessed'] = now
+            entry['expires'] = now + (self.ttl if ttl is None else ttl)
+            self.unsaved += 1
+        self.save()
+
+    def remove(self, key):
+        """
+            Removes an entry and its payload.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if not entry:
+                return
+            self.total_size -= entry['size']
+            self.unsaved += 1
+            if not self.inline:
+                self.pending.pop(key, None)
+                file_name = self.get_file_name(key)
+                if Data.Exists(file_name):
+                    Data.Remove(file_name)
+
+    def save(self, force=False):
+        """
+            Writes the cache index to disk, then the payloads stored since.
+            Unless forced, writes are batched to keep them cheap.
+            Payloads only reach the disk once the index knows about them,
+            so a restart can't leave behind files the cache doesn't track.
+            Must not be called with the cache lock held.
+        """
+        with self.save_lock:
+            with self.lock:
+                if not self.unsaved:
+                    return
+                due = (
+                    self.unsaved >= self.save_every or
+                    time.time() - self.last_save >= self.save_interval
+                )
+                if not force and not due:
+                    return
+                # Pickling a large index is slow, so write a snapshot
+                # and let other threads use the cache meanwhile
+                entries = dict(self.entries)
+                payloads = self.pending.items()
+                self.last_save = time.time()
+                self.unsaved = 0
+
+            Data.SaveObject(self.get_index_name(), entries)
+            for key, value in payloads:
+                if isinstance(value, basestring):
+                    Data.Save(self.get_file_name(key), value)
+                else:
+                    Data.SaveObject(self.get_file_name(key), value)
+
+            with self.lock:
+                for key, value in payloads:
+                    if self.pending.get(key) is value:
+                        del self.pending[key]
+                    elif key not in self.entries:
+                        # Removed while it was being written
+                        Data.Remove(self.get_file_name(key))
+
+    def set(self, key, value, ttl=None, **extra):
+        """
+            Stores a value under a key.
+            Any extra keyword arguments are stored alongside the entry.
+        """
+        self.set_many([(key, value)], ttl, **extra)
+
+    def set_many(self, items, ttl=None, **extra):
+        """
+            Stores (key, value) pairs, counted as a single index write
+            so a batch doesn't cause a flush of its own.
+            Any extra keyword arguments are stored alongside each entry.
+        """
+        with self.lock:
+            self.load()
+            now = time.time()
+            for key, value in items:
+                previous = self.entries.get(key)
+                if previous:
+                    self.total_size -= previous['size']
+                entry = dict(extra)
+                entry['accessed'] = now
+                entry['expires'] = now + (self.ttl if ttl is None else ttl)
+                entry['size'] = self.estimate_size(value)
+                if self.inline:
+                    entry['value'] = value
+                else:
+                    # Anything but raw bytes is stored as an object
+                    entry['pickled'] = not isinstance(value, basestring)
+                    self.pending[key] = value
+                self.entries[key] = entry
+                self.total_size += entry['size']
+            self.unsaved += 1
+            self.evict()
+        self.save()
+
+
+# API responses, keyed by content type, ASIN and region
+response_cache = CacheTool(
+    'responses',
+    ttl=CACHE_WEEK,
+    max_size=256 * 1024 * 1024,
+    stale_ttl=4 * CACHE_WEEK
+)
+
+# Parsed search results, keyed by content type, region and query.
+# One file per search keeps the index small enough to flush often.
+search_cache = CacheTool('searches', ttl=CACHE_DAY, max_size=32 * 1024 * 1024)
+
+# Searches and items which came up empty, keyed like the above
+negative_cache = CacheTool(
+    'negative', ttl=CACHE_DAY, max_size=8 * 1024 * 1024, inline=True
+)
+
+# Image dimensions and square crop URLs, keyed by image URL
+image_size_cache = CacheTool(
+    'image_sizes', ttl=4 * CACHE_WEEK, max_size=4 * 1024 * 1024, inline=True
+)
+
+# Fingerprints of the last applied updates, keyed by metadata ID.
+# Refreshes walk the whole library in order, which a size budget smaller
+# than the library would evict entirely, so every item keeps its file.
+# Losing recent ones on a restart only means updating those items again.
+fingerprint_cache = CacheTool(
+    'fingerprints',
+    ttl=26 * CACHE_WEEK,
+    max_size=None,
+    save_every=1000,
+    save_interval=CACHE_HOUR
+)
@@ -0,0 +1,152 @@
+import heapq
+import math
+import re
+import threading
+# Import internal tools
+from cache_tools import CACHE_HOUR, CACHE_WEEK, CacheTool
+from logging import Logging
+
+# Setup logger
+log = Logging()
+
+
+class CatalogTool:
+    """
+        Local catalog of products seen in search results,
+        with an in-memory character trigram index over
+        their titles and authors for fuzzy lookups.
+
+        Parameters
+        ----------
+        cache : CacheTool
+            Inline cache holding the products, keyed by ID.
+    """
+    # Candidates returned by a lookup
+    MAX_CANDIDATES = 10
+    # Minimum share of the query's trigrams a candidate must contain.
+    # Anything less similar is unlikely to score well enough anyway.
+    MIN_SIMILARITY = 0.5
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.postings = None
+        self.trigrams = {}
+
+    def add(self, products):
+        """
+            Records search result products and indexes them.
+            The products are stored as one batch,
+            so the catalog index isn't flushed to disk for each of them.
+        """
+        self.cache.set_many(
+            [(product['asin'], product) for product in products]
+        )
+        with self.lock:
+            self.build_index()
+            for product in products:
+                self.index_product(product)
+
+    def build_index(self):
+        """
+            Builds the trigram index from the stored products, once.
+            Expects the lock to be held.
+        """
+        if self.postings is not None:
+            return
+        self.postings = {}
+        for _, product in self.cache.items():
+            self.index_product(product)
+        log.debug('Indexed %s catalog products', len(self.trigrams))
+
+    def get_product_text(self, product):
+        """
+            Returns the text a product is indexed under.
+        """
+        return ' '.join(
+            [product['title']] +
+            [author['name'] for author in product['author']]
+        )
+
+    def get_trigrams(self, text):
+        """
+            Returns the set of character trigrams of each word in a text.
+            Words are padded so short words and word edges count too.
+        """
+        trigrams = set()
+        for word in re.findall(r'\w+', text.lower(), flags=re.UNICODE):
+            padded = ' ' + word + ' '
+            for start in range(len(padded) - 2):
+                trigrams.add(padded[start:start + 3])
+        return trigrams
+
+    def index_product(self, product):
+        """
+            Adds a product to the trigram index.
+            Expects the lock to be held.
+        """
+        product_id = product['asin']
+        if product_id in self.trigrams:
+            return
+        trigrams = frozenset(
+            self.get_trigrams(self.get_product_text(product))
+        )
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, []).append(product_id)
+        self.trigrams[product_id] = trigrams
+
+    def search(self, title, author, regions):
+        """
+            Returns the stored products most similar to a title and author,
+            limited to the given regions, best first.
+        """
+        query = self.get_trigrams(title + ' ' + (author or ''))
+        if not query:
+            return []
+
+        with self.lock:
+            self.build_index()
+            # A product similar enough shares at least this many trigrams,
+            # so it must appear in one of the rarest remaining ones
+            min_shared = int(math.ceil(self.MIN_SIMILARITY * len(query)))
+            by_rarity = sorted(
+                query, key=lambda trigram: len(self.postings.get(trigram, ()))
+            )
+            seen = set()
+            for trigram in by_rarity[:len(query) - min_shared + 1]:
+                seen.update(self.postings.get(trigram, ()))
+
+            scored = []
+            for product_id in seen:
+                trigrams = self.trigrams[product_id]
+                # Share of the query found in the product,
+                # closer (smaller) products win ties
+                similarity = float(len(query & trigrams)) / len(query)
+                if similarity >= self.MIN_SIMILARITY:
+                    scored.append((similarity, -len(trigrams), product_id))
+            best = heapq.nlargest(self.MAX_CANDIDATES * 2, scored)
+
+        candidates = []
+        for _, _, product_id in best:
+            product = self.cache.get(product_id)
+            # Products evicted from the cache stay in the index until restart
+            if product and product['region'] in regions:
+                candidates.append(product)
+                if len(candidates) >= self.MAX_CANDIDATES:
+                    break
+        return candidates
+
+
+# Books seen in search results, keyed by ASIN and region
+book_catalog = CatalogTool(
+    CacheTool(
+        'catalog',
+        ttl=4 * CACHE_WEEK,
+        max_size=64 * 1024 * 1024,
+        inline=True,
+        # The whole catalog is pickled on each flush, and losing
+        # the latest products on a restart costs nothing but a search
+        save_every=1000,
+        save_interval=CACHE_HOUR
+    )
+)
@@ -0,0 +1,136 @@
+# Strings up to this length use the bit-parallel algorithm
+BIT_PARALLEL_MAX_LENGTH = 64
+
+
+def levenshtein_distance(first, second, max_distance=None):
+    """
+        Returns the Levenshtein distance between two strings.
+
+        If max_distance is given, the computation stops as soon as
+        the distance is known to be larger, and max_distance + 1
+        is returned instead of the exact distance.
+    """
+    if first == second:
+        return 0
+
+    # Common prefixes and suffixes never add to the distance
+    start = 0
+    shortest = min(len(first), len(second))
+    while start < shortest and first[start] == second[start]:
+        start += 1
+    end = 0
+    while (
+        end < shortest - start and
+        first[-1 - end] == second[-1 - end]
+    ):
+        end += 1
+    first = first[start:len(first) - end]
+    second = second[start:len(second) - end]
+
+    # Make the first string the shorter one
+    if len(first) > len(second):
+        first, second = second, first
+
+    if max_distance is not None:
+        # Length difference alone is a lower bound
+        if len(second) - len(first) > max_distance:
+            return max_distance + 1
+    if not first:
+        return len(second)
+
+    if len(first) <= BIT_PARALLEL_MAX_LENGTH:
+        return bit_parallel_distance(first, second, max_distance)
+    return banded_distance(first, second, max_distance)
+
+
+def bit_parallel_distance(pattern, text, max_distance=None):
+    """
+        Myers/Hyyro bit-parallel edit distance.
+        Processes one character of text per step, with the whole
+        column of the pattern encoded in integer bit vectors.
+        Expects a non-empty pattern that is not longer than the text.
+    """
+    length = len(pattern)
+    mask = (1 << length) - 1
+    last_bit = 1 << (length - 1)
+
+    # Bit masks of where each character occurs in the pattern
+    char_masks = {}
+    for index, char in enumerate(pattern):
+        char_masks[char] = char_masks.get(char, 0) | (1 << index)
+
+    positive = mask
+    negative = 0
+    distance = length
+    remaining = len(text)
+    for char in text:
+        remaining -= 1
+        match = char_masks.get(char, 0)
+        vertical = match | negative
+        horizontal = (((match & positive) + positive) ^ positive) | match
+        positive_h = negative | ~(horizontal | positive)
+        negative_h = positive & horizontal
+
+        if positive_h & last_bit:
+            distance += 1
+        elif negative_h & last_bit:
+            distance -= 1
+
+        # Each remaining character can lower the distance by one at most
+        if max_distance is not None and distance - remaining > max_distance:
+            return max_distance + 1
+
+        positive_h = (positive_h << 1) | 1
+        negative_h = negative_h << 1
+        positive = (negative_h | ~(vertical | positive_h)) & mask
+        negative = positive_h & vertical & mask
+
+    return distance
+
+
+def banded_distance(first, second, max_distance=None):
+    """
+        Dynamic programming edit distance. With max_distance, only cells
+        within that distance of the diagonal are computed (Ukkonen),
+        and rows stop as soon as every cell exceeds it.
+    """
+    first_length = len(first)
+    second_length = len(second)
+    if max_distance is None:
+        band = second_length
+    else:
+        band = max_distance
+    too_far = band + 1
+
+    previous = [
+        column if column <= band else too_far
+        for column in range(second_length + 1)
+    ]
+    for row in range(1, first_length + 1):
+        low = max(1, row - band)
+        high = min(second_length, row + band)
+        current = [too_far] * (second_length + 1)
+        if row <= band:
+            current[0] = row
+        char = first[row - 1]
+        row_min = current[0]
+        for column in range(low, high + 1):
+            cost = 0 if char == second[column - 1] else 1
+            value = min(
+                previous[column] + 1,
+                current[column - 1] + 1,
+                previous[column - 1] + cost,
+            )
+            if value > too_far:
+                value = too_far
+            current[column] = value
+            if value < row_min:
+                row_min = value
+        if max_distance is not None and row_min > max_distance:
+            return max_distance + 1
+        previous = current
+
+    distance = previous[second_length]
+    if max_distance is not None and distance > max_distance:
+        return max_distance + 1
+    return distance
@@ -0,0 +1,48 @@
+# coding: utf-8
+from htmlentitydefs import name2codepoint
+import re
+
+html_entity_regex = re.compile(r'&(#[xX]?)?(\w+);')
+html_tag_regex = re.compile(r'<[^<]+?>')
+
+
+def replace_html_special(input_html):
+    """
+        Replaces HTML lists with a bullet point.
+        Replaces HTML paragraphs with a newline.
+        Replaces HTML line breaks with a newline.
+        Drops all other tags, such as <b> and <i>, then decodes entities.
+    """
+    text = (
+        input_html.replace(u"<ul>", u"")
+        .replace(u"</ul>", u"\n")
+        .replace(u"<ol>", u"")
+        .replace(u"</ol>", u"\n")
+        .replace(u"<li>", u" • ")
+        .replace(u"</li>", u"\n")
+        .replace(u"<br />", u"")
+        .replace(u"<p>", u"")
+        .replace(u"</p>", u"\n")
+        .strip()
+    )
+    text = html_tag_regex.sub(u'', text)
+    # Most summaries have no entities, skip the extra scan for those
+    if u'&' in text:
+        text = html_entity_regex.sub(decode_entity, text)
+    return text
+
+
+def decode_entity(match):
+    """
+        Returns the character for a named or numeric entity match.
+        Unknown entities and invalid code points are kept as they are.
+    """
+    prefix, name = match.groups()
+    try:
+        if not prefix:
+            return unichr(name2codepoint[name])
+        if prefix == '#':
+            return unichr(int(name))
+        return unichr(int(name, 16))
+    except (KeyError, OverflowError, ValueError):
+        return match.group(0)
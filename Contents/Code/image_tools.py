@@ -0,0 +1,124 @@
+import struct
+# Import internal tools
+from logging import Logging
+from request_tools import send_request
+
+# Setup logger
+log = Logging()
+
+# Bytes asked for by the first range request, doubled as needed
+PROBE_CHUNK_SIZE = 4 * 1024
+# Give up on images whose dimensions are not within this many bytes
+MAX_PROBE_SIZE = 512 * 1024
+
+
+class ImageSizeError(Exception):
+    """
+        Raised when the dimensions of an image can't be read.
+    """
+
+
+def probe_image_size(image_url):
+    """
+        Returns the (width, height) of a remote JPEG, PNG or WebP image.
+        Only the start of the image is downloaded, with range requests
+        that grow until the header holding the dimensions is complete.
+    """
+    length = PROBE_CHUNK_SIZE
+    while True:
+        response = send_request(
+            image_url, headers={'Range': 'bytes=0-' + str(length - 1)}
+        )
+        data = response.content
+        size = parse_image_size(data)
+        if size:
+            log.debug(
+                'Read image size %sx%s from %s bytes',
+                size[0], size[1], len(data)
+            )
+            return size
+        # The server sent everything it has, or ignored the range
+        if len(data) < length or response.status != 206:
+            raise ImageSizeError('Incomplete image header: ' + image_url)
+        if length >= MAX_PROBE_SIZE:
+            raise ImageSizeError('Image header too large: ' + image_url)
+        length *= 2
+
+
+def parse_image_size(data):
+    """
+        Returns the (width, height) of an image from its first bytes,
+        or None if more bytes are needed.
+        Raises ImageSizeError for unsupported formats.
+    """
+    if data[:2] == '\xff\xd8':
+        return parse_jpeg_size(data)
+    if data[:8] == '\x89PNG\r\n\x1a\n':
+        return parse_png_size(data)
+    if data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+        return parse_webp_size(data)
+    if len(data) < 12:
+        return None
+    raise ImageSizeError('Unsupported image format')
+
+
+def parse_jpeg_size(data):
+    """
+        Reads the dimensions from the JPEG start of frame (SOFn) segment,
+        skipping over the segments before it.
+    """
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != '\xff':
+            raise ImageSizeError('Invalid JPEG marker')
+        marker = ord(data[offset + 1])
+        if marker == 0xff:
+            # Fill byte before the marker
+            offset += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            # Markers without a segment
+            offset += 2
+            continue
+        # DHT, JPG and DAC share the range of the SOFn markers
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        if marker == 0xda:
+            raise ImageSizeError('No JPEG frame before scan data')
+        offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return None
+
+
+def parse_png_size(data):
+    """
+        Reads the dimensions from the PNG IHDR chunk.
+    """
+    if len(data) < 24:
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def parse_webp_size(data):
+    """
+        Reads the dimensions from the first WebP chunk,
+        for lossy (VP8), lossless (VP8L) and extended (VP8X) images.
+    """
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == 'VP8 ':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == 'VP8L':
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    if chunk == 'VP8X':
+        # 24 bit sizes, padded to 32 bits
+        width, height = struct.unpack(
+            '<II', data[24:27] + '\x00' + data[27:30] + '\x00'
+        )
+        return width + 1, height + 1
+    raise ImageSizeError('Unsupported WebP chunk')
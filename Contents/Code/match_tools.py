@@ -0,0 +1,120 @@
+import re
+import threading
+# Import internal tools
+from cache_tools import CACHE_WEEK, CacheTool
+from logging import Logging
+
+# Setup logger
+log = Logging()
+
+
+class MatchIndexTool:
+    """
+        Local index from a normalized search (title, author and region)
+        to the ID of the item it was matched to.
+
+        Search results are proposed for a key while searching,
+        and only stored once Plex updates one of them for the same media,
+        which means the match was accepted.
+    """
+    # Proposals kept in memory while waiting for an update
+    MAX_PENDING = 1000
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def add(self, key, item_id):
+        """
+            Stores a confirmed match.
+        """
+        log.debug('Indexing match %s -> %s', key, item_id)
+        self.cache.set(key, item_id)
+
+    def build_name_key(self, name):
+        """
+            Builds a key from a name, ignoring case, diacritics,
+            punctuation and whitespace.
+        """
+        return re.sub(
+            r'\W+', '', String.StripDiacritics(name).lower(), flags=re.UNICODE
+        )
+
+    def confirm(self, item_id, media_name):
+        """
+            Stores the match for an item that was proposed by a search
+            of the same media.
+            Other proposals for the same search are dropped.
+        """
+        media_key = self.build_name_key(media_name or '')
+        with self.lock:
+            proposal = self.pending.get(item_id)
+            if not proposal or proposal[1] != media_key:
+                return
+            key = proposal[0]
+            for other_id, other in self.pending.items():
+                if other[0] == key:
+                    del self.pending[other_id]
+        # A different match for the same media replaces the earlier one
+        media_entry = 'media:' + media_key
+        previous_key = self.cache.get(media_entry)
+        if (
+            previous_key and previous_key != key and
+            self.cache.get(previous_key) != item_id
+        ):
+            log.debug('Dropping replaced match %s', previous_key)
+            self.cache.remove(previous_key)
+        self.add(key, item_id)
+        self.cache.set(media_entry, key)
+
+    def get(self, key):
+        """
+            Returns the ID previously matched for a key, or None.
+        """
+        return self.cache.get(key)
+
+    def propose(self, key, item_ids, media_name):
+        """
+            Remembers search results for a key,
+            in case Plex goes on to update one of them for the same media.
+
+            Parameters
+            ----------
+            key : str
+                Normalized search the results were found for.
+            item_ids : list
+                IDs Plex may pick, only the top result for automatic matches.
+            media_name : str
+                Title of the media being matched,
+                as Plex passes it to the update.
+        """
+        media_key = self.build_name_key(media_name or '')
+        if not media_key:
+            return
+        with self.lock:
+            if len(self.pending) + len(item_ids) > self.MAX_PENDING:
+                self.pending.clear()
+            for item_id in item_ids:
+                self.pending[item_id] = (key, media_key)
+
+
+# Books, keyed by region, normalized title and author
+book_match_index = MatchIndexTool(
+    CacheTool(
+        'book_matches',
+        ttl=26 * CACHE_WEEK,
+        max_size=64 * 1024 * 1024,
+        inline=True
+    )
+)
+
+# Authors, keyed by name and learned from book updates
+author_match_index = MatchIndexTool(
+    CacheTool(
+        'author_matches',
+        ttl=26 * CACHE_WEEK,
+        max_size=16 * 1024 * 1024,
+        inline=True
+    )
+)
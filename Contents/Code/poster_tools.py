@@ -0,0 +1,66 @@
+import hashlib
+# Import internal tools
+from cache_tools import CACHE_WEEK, CacheTool
+from logging import Logging
+
+# Setup logger
+log = Logging()
+
+
+class PosterStoreTool:
+    """
+        Local store of poster images, shared by books and authors.
+        Images are stored once per content hash,
+        and poster URLs map to the hash of their image.
+
+        Parameters
+        ----------
+        url_cache : CacheTool
+            Inline cache mapping poster URLs to content hashes.
+        content_cache : CacheTool
+            Cache holding the image bytes, keyed by content hash.
+    """
+
+    def __init__(self, url_cache, content_cache):
+        self.url_cache = url_cache
+        self.content_cache = content_cache
+
+    def add(self, url, image):
+        """
+            Stores the image downloaded from a poster URL.
+        """
+        digest = hashlib.sha1(image).hexdigest()
+        if self.content_cache.has(digest):
+            # Same image as another URL, or stored before
+            self.content_cache.refresh(digest)
+        else:
+            self.content_cache.set(digest, image)
+        self.url_cache.set(url, digest)
+
+    def get(self, url):
+        """
+            Returns the stored image for a poster URL, or None.
+        """
+        digest = self.url_cache.get(url)
+        if not digest:
+            return None
+        image = self.content_cache.get(digest)
+        if image is not None:
+            log.debug('Using stored poster for ' + url)
+        return image
+
+
+# Poster images of books and authors
+poster_store = PosterStoreTool(
+    CacheTool(
+        'poster_urls',
+        ttl=8 * CACHE_WEEK,
+        max_size=8 * 1024 * 1024,
+        inline=True
+    ),
+    CacheTool(
+        'posters',
+        ttl=8 * CACHE_WEEK,
+        max_size=512 * 1024 * 1024
+    )
+)
@@ -0,0 +1,246 @@
+import io
+import struct
+# Import internal tools
+from logging import Logging
+
+# Setup logger
+log = Logging()
+
+
+class TagProbeTool:
+    """
+        Reads a few custom tags from an audio file,
+        without reading the audio itself.
+        Only headers and metadata are read, with seeks past everything else,
+        so probing a large audiobook file costs a handful of small reads.
+
+        Supports MP4 freeform atoms (----:com.apple.iTunes:NAME),
+        ID3v2 TXXX and COMM frames, and FLAC Vorbis comments.
+
+        Parameters
+        ----------
+        path : str
+            Path of the audio file.
+    """
+    # Tag names to collect, uppercased
+    TAG_NAMES = ('ASIN', 'AUDIBLE_ASIN', 'AUDIBLE_REGION')
+    # Largest tag payload that is read, larger ones are skipped
+    MAX_FIELD_SIZE = 64 * 1024
+    # MP4 container atoms leading to the freeform tags
+    MP4_PATH = ('moov', 'udta', 'meta', 'ilst')
+    ID3_ENCODINGS = {
+        0: ('latin-1', '\x00'),
+        1: ('utf-16', '\x00\x00'),
+        2: ('utf-16-be', '\x00\x00'),
+        3: ('utf-8', '\x00'),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.tags = {}
+
+    def probe(self):
+        """
+            Returns a dict of the wanted tags found in the file,
+            keyed by uppercased tag name.
+        """
+        try:
+            with io.open(self.path, 'rb') as audio_file:
+                magic = audio_file.read(12)
+                audio_file.seek(0)
+                if magic[:3] == 'ID3':
+                    self.probe_id3(audio_file)
+                elif magic[:4] == 'fLaC':
+                    self.probe_flac(audio_file)
+                elif magic[4:8] == 'ftyp':
+                    size = self.get_file_size(audio_file)
+                    self.probe_mp4(audio_file, 0, size, 0)
+        except (IOError, OSError, struct.error) as e:
+            log.warn('Could not read tags from %s: %s', self.path, e)
+        if self.tags:
+            log.debug('Found tags in file: %s', self.tags)
+        return self.tags
+
+    def add_tag(self, name, value):
+        """
+            Stores a tag if it is one of the wanted ones.
+        """
+        name = name.strip().upper()
+        if name in self.TAG_NAMES and value and name not in self.tags:
+            self.tags[name] = value.strip()
+
+    def get_file_size(self, audio_file):
+        """
+            Returns the size of an open file.
+        """
+        audio_file.seek(0, 2)
+        size = audio_file.tell()
+        audio_file.seek(0)
+        return size
+
+    # MP4
+    def probe_mp4(self, audio_file, start, end, depth):
+        """
+            Walks the atoms between two offsets, descending only
+            into the containers on the way to the tag list.
+        """
+        offset = start
+        while offset + 8 <= end:
+            audio_file.seek(offset)
+            size, kind = struct.unpack('>I4s', audio_file.read(8))
+            header_size = 8
+            if size == 1:
+                size = struct.unpack('>Q', audio_file.read(8))[0]
+                header_size = 16
+            elif size == 0:
+                size = end - offset
+            if size < header_size:
+                return
+
+            content_start = offset + header_size
+            if depth < len(self.MP4_PATH) and kind == self.MP4_PATH[depth]:
+                # meta is a full box, with version and flags first
+                if kind == 'meta':
+                    content_start += 4
+                self.probe_mp4(
+                    audio_file, content_start, offset + size, depth + 1
+                )
+            elif depth == len(self.MP4_PATH) and kind == '----':
+                if size - header_size <= self.MAX_FIELD_SIZE:
+                    self.read_mp4_freeform(
+                        audio_file.read(size - header_size)
+                    )
+            offset += size
+
+    def read_mp4_freeform(self, content):
+        """
+            Reads a freeform tag: mean, name and data atoms.
+        """
+        fields = {}
+        offset = 0
+        while offset + 8 <= len(content):
+            size, kind = struct.unpack('>I4s', content[offset:offset + 8])
+            if size < 8:
+                return
+            # Each child is a full box, skip version and flags
+            fields[kind] = content[offset + 12:offset + size]
+            offset += size
+        if fields.get('mean') != 'com.apple.iTunes' or 'data' not in fields:
+            return
+        # data has a locale before the value
+        self.add_tag(
+            fields.get('name', ''),
+            fields['data'][4:].decode('utf-8', 'replace')
+        )
+
+    # ID3
+    def probe_id3(self, audio_file):
+        """
+            Walks the ID3v2 frames, reading only TXXX and COMM frames.
+        """
+        header = audio_file.read(10)
+        if len(header) < 10:
+            return
+        version = ord(header[3])
+        flags = ord(header[5])
+        end = 10 + self.read_syncsafe(header[6:10])
+        if flags & 0x40 and version >= 3:
+            # Skip extended header
+            extended = audio_file.read(4)
+            if len(extended) < 4:
+                return
+            extended_size = (
+                self.read_syncsafe(extended) if version == 4
+                else struct.unpack('>I', extended)[0] + 4
+            )
+            audio_file.seek(10 + extended_size)
+
+        if version == 2:
+            header_size, id_size, wanted = 6, 3, ('TXX', 'COM')
+        else:
+            header_size, id_size, wanted = 10, 4, ('TXXX', 'COMM')
+
+        offset = audio_file.tell()
+        while offset + header_size <= end:
+            audio_file.seek(offset)
+            frame_header = audio_file.read(header_size)
+            if len(frame_header) < header_size:
+                return
+            frame_id = frame_header[:id_size]
+            if not frame_id.strip('\x00'):
+                # Reached the padding
+                return
+            if version == 2:
+                size = struct.unpack('>I', '\x00' + frame_header[3:6])[0]
+            elif version == 4:
+                size = self.read_syncsafe(frame_header[4:8])
+            else:
+                size = struct.unpack('>I', frame_header[4:8])[0]
+
+            if frame_id in wanted and size <= self.MAX_FIELD_SIZE:
+                self.read_id3_frame(frame_id[:3], audio_file.read(size))
+            offset += header_size + size
+
+    def read_id3_frame(self, frame_id, content):
+        """
+            Reads the description and value of a TXXX or COMM frame.
+        """
+        if not content or ord(content[0]) not in self.ID3_ENCODINGS:
+            return
+        encoding, terminator = self.ID3_ENCODINGS[ord(content[0])]
+        # COMM has a language code before the description
+        content = content[4:] if frame_id == 'COM' else content[1:]
+
+        # Find the terminator, aligned to the character width
+        split = content.find(terminator)
+        while split != -1 and split % len(terminator):
+            split = content.find(terminator, split + 1)
+        if split == -1:
+            return
+        description = content[:split].decode(encoding, 'replace')
+        value = content[split + len(terminator):].decode(encoding, 'replace')
+        self.add_tag(description, value.rstrip(u'\x00'))
+
+    def read_syncsafe(self, data):
+        """
+            Decodes a 28 bit ID3 syncsafe integer.
+        """
+        return reduce(
+            lambda total, byte: total << 7 | ord(byte) & 0x7f, data, 0
+        )
+
+    # FLAC
+    def probe_flac(self, audio_file):
+        """
+            Walks the FLAC metadata blocks, reading only Vorbis comments.
+        """
+        audio_file.seek(4)
+        last = False
+        while not last:
+            header = audio_file.read(4)
+            if len(header) < 4:
+                return
+            last = bool(ord(header[0]) & 0x80)
+            kind = ord(header[0]) & 0x7f
+            size = struct.unpack('>I', '\x00' + header[1:])[0]
+            if kind == 4 and size <= self.MAX_FIELD_SIZE:
+                self.read_vorbis_comments(audio_file.read(size))
+            else:
+                audio_file.seek(size, 1)
+
+    def read_vorbis_comments(self, content):
+        """
+            Reads NAME=value pairs from a Vorbis comment block.
+        """
+        vendor_size = struct.unpack('<I', content[:4])[0]
+        offset = 4 + vendor_size
+        count = struct.unpack('<I', content[offset:offset + 4])[0]
+        offset += 4
+        # Each comment takes at least 4 bytes, ignore a corrupt count
+        count = min(count, (len(content) - offset) // 4)
+        for _ in xrange(count):
+            size = struct.unpack('<I', content[offset:offset + 4])[0]
+            comment = content[offset + 4:offset + 4 + size]
+            offset += 4 + size
+            name, _, value = comment.partition('=')
+            self.add_tag(name, value.decode('utf-8', 'replace'))
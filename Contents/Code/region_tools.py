@@ -59,6 +59,12 @@ class RegionTool:
             The region code to generate the URL for.
     """
 
+    # Audible search defaults
+    API_NUM_RESULTS = 25
+    API_RESPONSE_GROUPS = ('contributors', 'product_desc', 'product_attrs')
+    # Only what is needed to parse and score search results
+    API_SCORING_RESPONSE_GROUPS = ('contributors', 'product_attrs')
+
     def __init__(self, region, content_type, id=None, query=None):
         self.region = region
         self.id = id
@@ -123,17 +129,33 @@ class RegionTool:
             available_regions[self.region]['TLD']
         )
 
-    def get_api_params(self):
+    def get_api_params(
+        self,
+        num_results=None,
+        response_groups=None,
+        page=None
+    ):
         """
             Returns the API parameters.
+            Page numbers start at 1, and the first page is implied.
         """
-        return (
-            '?response_groups=contributors,product_desc,product_attrs'
-            '&num_results=25&products_sort_by=Relevance'
+        params = (
+            '?response_groups=' +
+            ','.join(response_groups or self.API_RESPONSE_GROUPS) +
+            '&num_results=' + str(num_results or self.API_NUM_RESULTS) +
+            '&products_sort_by=Relevance'
         )
+        if page and page > 1:
+            params += '&page=' + str(page)
+        return params
 
-    def get_api_search_url(self):
+    def get_api_search_url(
+        self,
+        num_results=None,
+        response_groups=None,
+        page=None
+    ):
         """
             Returns the API search URL.
         """
-        return self.get_api_region_url() + '/' + '1.0/catalog/products' + self.get_api_params() + '&' + self.query
+        return self.get_api_region_url() + '/' + '1.0/catalog/products' + self.get_api_params(num_results, response_groups, page) + '&' + self.query
@@ -0,0 +1,431 @@
+from email.utils import mktime_tz, parsedate_tz
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib
+import urlparse
+# Import internal tools
+from logging import Logging
+from transport_tools import HTTPStatusError, get_transport
+
+# Setup logger
+log = Logging()
+
+
+class CircuitOpenError(Exception):
+    """
+        Raised instead of making a request to a host
+        whose circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+        Tracks the health of a single host.
+
+        closed: requests flow normally and failures are counted.
+        open: requests fail fast until the reset timeout passes.
+        half-open: a single trial request is let through;
+            success closes the circuit, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    # Consecutive failures before the circuit opens
+    FAILURE_THRESHOLD = 5
+    # Seconds to wait before letting a trial request through
+    RESET_TIMEOUT = 60
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.open_until = 0
+        self.state = self.CLOSED
+
+    def before_request(self):
+        """
+            Raises CircuitOpenError if requests should not be made now.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.time() >= self.open_until:
+                log.info('Circuit for %s is half-open, trying it', self.host)
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(
+                'Circuit for ' + self.host + ' is ' + self.state
+            )
+
+    def open(self, seconds=None):
+        """
+            Opens the circuit for the given number of seconds.
+        """
+        with self.lock:
+            self.trip(seconds or self.RESET_TIMEOUT)
+
+    def record_failure(self):
+        """
+            Counts a failed request, opening the circuit if needed.
+        """
+        with self.lock:
+            self.failures += 1
+            if (
+                self.state == self.HALF_OPEN or
+                self.failures >= self.FAILURE_THRESHOLD
+            ):
+                self.trip(self.RESET_TIMEOUT)
+
+    def record_success(self):
+        """
+            Closes the circuit after a successful request.
+        """
+        with self.lock:
+            if self.state != self.CLOSED:
+                log.info('Circuit for %s is closed again', self.host)
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def trip(self, seconds):
+        """
+            Opens the circuit. Expects the lock to be held.
+        """
+        if self.state != self.OPEN:
+            log.warn(
+                'Circuit for %s is open for %s seconds', self.host, seconds
+            )
+        self.state = self.OPEN
+        self.open_until = max(self.open_until, time.time() + seconds)
+
+
+class RetryPolicy:
+    """
+        Decides whether and when a failed request is retried.
+        Uses exponential backoff with full jitter,
+        unless the server asks for a delay with Retry-After.
+    """
+    MAX_ATTEMPTS = 4
+    # Backoff bounds, in seconds
+    BASE_DELAY = 1
+    MAX_DELAY = 30
+    # Longer Retry-After values are not waited for in-line
+    MAX_RETRY_AFTER = 60
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def get_backoff(self, attempt):
+        """
+            Returns a jittered delay for the given attempt number.
+        """
+        ceiling = min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def get_retry_after(self, error):
+        """
+            Returns the Retry-After delay of a failed response in seconds,
+            or None if there is none.
+        """
+        if not isinstance(error, HTTPStatusError):
+            return None
+        value = error.response.header('retry-after')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return int(value)
+        parsed_date = parsedate_tz(value)
+        if parsed_date:
+            return max(0, mktime_tz(parsed_date) - time.time())
+
+    def is_host_failure(self, error):
+        """
+            Checks if an error means the host itself is unhealthy,
+            rather than the request being bad.
+        """
+        if isinstance(error, HTTPStatusError):
+            return error.status in self.RETRY_STATUSES
+        return isinstance(error, (httplib.HTTPException, socket.error))
+
+
+class TokenBucket:
+    """
+        Thread-safe token bucket.
+        Tokens refill continuously at the given rate, up to the capacity,
+        and each request takes one token, waiting for it if needed.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+
+    def acquire(self):
+        """
+            Takes a token, blocking until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+        Limits the request rate and the number of requests
+        in flight to a single host. Used as a context manager
+        around each request.
+
+        Parameters
+        ----------
+        host : str
+            The host being limited.
+        rate : float
+            Requests per second, or 0 for no rate limit.
+        max_in_flight : int
+            Maximum number of simultaneous requests.
+    """
+
+    def __init__(self, host, rate, max_in_flight):
+        self.host = host
+        self.bucket = TokenBucket(rate, max(1, rate)) if rate > 0 else None
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def __enter__(self):
+        self.in_flight.acquire()
+        if self.bucket:
+            try:
+                self.bucket.acquire()
+            except Exception:
+                self.in_flight.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.in_flight.release()
+
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls with the same key,
+        so only the first caller does the work and
+        the others wait for and share its result.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """
+            Runs func(*args), or waits for an identical call in flight.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {
+                    'done': threading.Event(),
+                    'error': None,
+                    'result': None,
+                }
+        if not leader:
+            log.debug('Joining in-flight request: ' + key)
+            call['done'].wait()
+            if call['error']:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args)
+            return call['result']
+        except Exception as err:
+            call['error'] = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+
+class Task:
+    """
+        Runs a function in a background thread.
+        result() waits for it, then returns its value or raises its error.
+    """
+
+    def __init__(self, func, *args):
+        self.done = threading.Event()
+        self.error = None
+        self.value = None
+        thread = threading.Thread(target=self.run, args=(func,) + args)
+        thread.daemon = True
+        thread.start()
+
+    def result(self):
+        """
+            Waits for the function to finish and returns its value.
+        """
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.value
+
+    def run(self, func, *args):
+        """
+            Calls the function and stores its outcome.
+        """
+        try:
+            self.value = func(*args)
+        except Exception as err:
+            self.error = err
+        finally:
+            self.done.set()
+
+
+# One breaker and one limiter per host, created on first use
+breakers = {}
+breakers_lock = threading.Lock()
+limiters = {}
+limiters_lock = threading.Lock()
+retry_policy = RetryPolicy()
+single_flight = SingleFlight()
+
+
+def get_breaker(url):
+    """
+        Returns the circuit breaker for the host of a URL.
+    """
+    host = urlparse.urlsplit(url).netloc
+    with breakers_lock:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker(host)
+        return breakers[host]
+
+
+def get_limiter(url):
+    """
+        Returns the rate limiter for the host of a URL,
+        configured from preferences.
+    """
+    host = urlparse.urlsplit(url).netloc
+    with limiters_lock:
+        if host not in limiters:
+            if host == 'api.audnex.us':
+                rate = get_number_pref('audnexus_requests_per_second', 10)
+            elif host.startswith('api.audible.'):
+                rate = get_number_pref('audible_requests_per_second', 5)
+            else:
+                rate = 0
+            max_in_flight = max(
+                1, int(get_number_pref('max_concurrent_requests', 4))
+            )
+            log.debug(
+                'Limiting %s to %s requests/s, %s at a time',
+                host, rate or 'unlimited', max_in_flight
+            )
+            limiters[host] = HostLimiter(host, rate, max_in_flight)
+        return limiters[host]
+
+
+def get_number_pref(pref_id, default):
+    """
+        Reads a numeric text preference,
+        falling back to the default if it is not a valid number.
+    """
+    try:
+        value = float(Prefs[pref_id])
+    except (KeyError, TypeError, ValueError):
+        log.warn(
+            'Invalid value for %s, using default: %s', pref_id, default
+        )
+        return default
+    return max(0, value)
+
+
+def normalize_url(url):
+    """
+        Normalizes a URL so equivalent requests compare equal:
+        lowercase scheme and host, and sorted query parameters.
+    """
+    parts = urlparse.urlsplit(url)
+    query = urllib.urlencode(
+        sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+    )
+    return urlparse.urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower(),
+        parts.path,
+        query,
+        ''
+    ))
+
+
+def reset_limiters():
+    """
+        Drops all limiters, so new ones pick up changed preferences.
+    """
+    with limiters_lock:
+        limiters.clear()
+
+
+def run_parallel(func, items):
+    """
+        Calls func on every item at the same time,
+        and returns the results in the same order.
+    """
+    tasks = [Task(func, item) for item in items]
+    return [task.result() for task in tasks]
+
+
+def send_request(url, headers=None, timeout=90):
+    """
+        Makes a request with retries, backoff, the host's rate limiter
+        and circuit breaker, and returns the successful Response.
+        Raises the last error once retries are exhausted.
+    """
+    breaker = get_breaker(url)
+    limiter = get_limiter(url)
+    for attempt in range(retry_policy.MAX_ATTEMPTS):
+        breaker.before_request()
+        try:
+            with limiter:
+                response = get_transport().request(
+                    url, headers=headers, timeout=timeout
+                )
+            response.raise_for_status()
+            breaker.record_success()
+            return response
+        except Exception as err:
+            log.error(
+                'Failed http request attempt #%s: %s', attempt + 1, url
+            )
+            log.error(err)
+            if not retry_policy.is_host_failure(err):
+                # The host answered, the request itself was bad
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= retry_policy.MAX_ATTEMPTS:
+                raise
+
+            delay = retry_policy.get_retry_after(err)
+            if delay is None:
+                delay = retry_policy.get_backoff(attempt)
+            elif delay > retry_policy.MAX_RETRY_AFTER:
+                # Don't block the queue, fail fast until the host is ready
+                breaker.open(delay)
+                raise
+            log.debug('Retrying in %.1f seconds', delay)
+            time.sleep(delay)
@@ -2,7 +2,8 @@ from datetime import date
 import re
 # Import internal tools
 from logging import Logging
-from region_tools import RegionTool
+from probe_tools import TagProbeTool
+from region_tools import RegionTool, available_regions
 import urllib
 
 # Setup logger
@@ -13,6 +14,10 @@ region_regex = re.compile(r'(?<=\[)[A-Za-z]{2}(?=\])')
 
 
 class SearchTool:
+    # Results per page, and pages at most, with adaptive paging
+    ADAPTIVE_PAGE_SIZE = 10
+    ADAPTIVE_MAX_PAGES = 3
+
     def __init__(self, content_type, lang, manual, media, prefs, results):
         self.content_type = content_type
         self.lang = lang
@@ -20,25 +25,67 @@ class SearchTool:
         self.media = media
         self.prefs = prefs
         self.results = results
+        # Search results page, starting at 1
+        self.page = 1
 
     def build_url(self, query):
         """
             Generates the URL string with search paramaters for API call.
         """
         # Pre-process title. If ASIN is found, return the URL
+        self.query = query
         pre_process = self.pre_process_title()
+        self.search_regions = [self.region_override]
         if pre_process:
             return pre_process
 
-        # Setup region helper to get search URL
-        region_helper = RegionTool(
-            content_type=self.content_type, query=query, region=self.region_override)
+        # Fan out to other regions, unless one was asked for explicitly
+        if self.content_type == 'books' and not self.region_in_title:
+            self.search_regions.extend(
+                region for region in self.get_extra_search_regions()
+                if region != self.region_override
+            )
 
-        search_url = region_helper.get_api_search_url(
-        ) if self.content_type == 'books' else region_helper.get_search_url()
+        search_url = self.build_region_url(self.region_override)
         self.log_search_url(search_url)
         return search_url
 
+    def build_region_url(self, region):
+        """
+            Generates the search URL for a single region.
+        """
+        # Setup region helper to get search URL
+        region_helper = RegionTool(
+            content_type=self.content_type, query=self.query, region=region)
+
+        if self.content_type != 'books':
+            return region_helper.get_search_url()
+        if self.uses_adaptive_paging():
+            return region_helper.get_api_search_url(
+                num_results=self.ADAPTIVE_PAGE_SIZE,
+                response_groups=RegionTool.API_SCORING_RESPONSE_GROUPS,
+                page=self.page
+            )
+        return region_helper.get_api_search_url()
+
+    def build_cache_key(self):
+        """
+            Builds the cache key for the search,
+            from the content type, region and search query.
+        """
+        parts = [
+            self.content_type,
+            'search',
+            '+'.join(self.search_regions),
+            self.query
+        ]
+        # Pages hold different results than a full search
+        if self.uses_adaptive_paging():
+            parts.append(
+                'page' + str(self.page) + 'of' + str(self.ADAPTIVE_PAGE_SIZE)
+            )
+        return '/'.join(parts)
+
     def check_for_asin(self):
         """
             Checks filename (for books) and/or search query for ASIN to quick match.
@@ -68,12 +115,43 @@ class SearchTool:
             self.check_for_region(manual_asin)
             return manual_search_asin.group(0) + '_' + self.region_override
 
+        # Check the file's tags for ASIN if content type is books
+        if self.media.filename and self.content_type == 'books':
+            return self.check_tags_for_asin()
+
+    def check_tags_for_asin(self):
+        """
+            Checks the tags of the media file for an ASIN to quick match.
+            A region tag is used as well, if there is a valid one.
+        """
+        try:
+            file_path = urllib.unquote(self.media.filename).decode('utf8')
+            tags = TagProbeTool(file_path).probe()
+        except Exception as e:
+            # A broken file shouldn't stop the search
+            log.warn('Could not probe file tags: %s', e)
+            return
+        tag_search_asin = self.search_asin(
+            tags.get('AUDIBLE_ASIN') or tags.get('ASIN')
+        )
+        if not tag_search_asin:
+            return
+
+        log.info('ASIN found in file tags')
+        self.check_for_region(self.media.album)
+        tag_region = (tags.get('AUDIBLE_REGION') or '').lower()
+        if not self.region_in_title and tag_region in available_regions:
+            self.region_override = tag_region
+            log.info('Region Override from file tags: %s', tag_region)
+        return tag_search_asin.group(0) + '_' + self.region_override
+
     # Check for region override
     def check_for_region(self, search_title):
         """
             Overrides the search with a region.
         """
         match_region = self.search_region(search_title)
+        self.region_in_title = bool(match_region)
         if match_region:
             log.info('Region found in title')
             self.region_override = match_region.group(0)
@@ -87,6 +165,22 @@ class SearchTool:
             return re.match(contributor_regex, string).group(0)
         return string
 
+    def get_extra_search_regions(self):
+        """
+            Reads the list of additional regions to search
+            from preferences, ignoring unknown region codes.
+        """
+        regions = []
+        for region in (self.prefs['search_regions'] or '').split(','):
+            region = region.strip().lower()
+            if not region:
+                continue
+            if region not in available_regions:
+                log.warn('Ignoring unknown search region: ' + region)
+                continue
+            regions.append(region)
+        return regions
+
     def log_search_url(self, search_url):
         """
             Logs the search URL.
@@ -157,6 +251,18 @@ class SearchTool:
         if input:
             return re.search(region_regex, input)
 
+    def uses_adaptive_paging(self):
+        """
+            Checks if book searches should fetch small pages of results,
+            only fetching more while none of them is good enough.
+            Manual searches always get the full result list.
+        """
+        return (
+            self.content_type == 'books' and
+            not self.manual and
+            bool(self.prefs['adaptive_search_paging'])
+        )
+
     def validate_author_name(self):
         """
             Checks a list of known bad author names.
@@ -200,6 +306,21 @@ class AlbumSearchTool(SearchTool):
         query = (album_param + artist_param)
         return query
 
+    def build_match_key(self):
+        """
+            Builds the local match index key for the search,
+            from the region, normalized title and author.
+        """
+        self.normalize_name()
+        self.check_for_region(self.media.album)
+        return '/'.join(
+            [
+                self.region_override,
+                self.normalizedName.lower(),
+                (self.media.artist or '').lower().strip(),
+            ]
+        )
+
     def check_if_preorder(self, book_date):
         """
             Checks if the book is a preorder.
@@ -273,11 +394,32 @@ class AlbumSearchTool(SearchTool):
 
         return name
 
-    def parse_api_response(self, api_response):
+    def merge_region_results(self, region_results):
+        """
+            Merges per-region result lists into one list.
+            Results are interleaved by their rank in each region,
+            so relevance is kept, and duplicate ASINs are dropped.
+        """
+        merged = []
+        seen_asins = set()
+        longest = max([len(results) for results in region_results] + [0])
+        for rank in range(longest):
+            for results in region_results:
+                if rank >= len(results):
+                    continue
+                asin = results[rank]['asin'].split('_')[0]
+                if asin in seen_asins:
+                    continue
+                seen_asins.add(asin)
+                merged.append(results[rank])
+        return merged
+
+    def parse_api_response(self, api_response, region=None):
         """
             Collects keys used for each item from API response,
             for Plex search results.
         """
+        region = region or self.region_override
         search_results = []
         for item in api_response['products']:
             # Only append results which have valid keys
@@ -291,12 +433,12 @@ class AlbumSearchTool(SearchTool):
             }:
                 search_results.append(
                     {
-                        'asin': item['asin'] + '_' + self.region_override,
+                        'asin': item['asin'] + '_' + region,
                         'author': item['authors'],
                         'date': item['release_date'],
                         'language': item['language'],
                         'narrator': item['narrators'],
-                        'region': self.region_override,
+                        'region': region,
                         'title': item['title'],
                     }
                 )
@@ -518,9 +660,38 @@ class ScoreTool:
             .replace(',', '')
         return normalized
 
-    def run_score_author(self):
+    def get_library_language(self):
+        """
+            Returns the name of the library language,
+            as used by Audible.
+        """
+        lang_dict = {
+            self.english_locale: 'English',
+            'de': 'German',
+            'es': 'Spanish',
+            'fr': 'French',
+            'it': 'Italian',
+            'ja': 'Japanese',
+        }
+        return lang_dict[self.helper.lang]
+
+    def get_query_album(self):
+        """
+            Returns the reduced album title being searched for, if any.
+        """
+        if self.helper.media.album:
+            return self.reduce_string(self.helper.media.album)
+
+    def get_query_author(self):
+        """
+            Returns the reduced author being searched for, if any.
+        """
+        if self.helper.media.artist:
+            return self.reduce_string(self.helper.media.artist)
+
+    def load_author(self):
         """
-            Scores an author result.
+            Loads the fields of an author result.
         """
         self.asin = self.result_dict['asin']
         self.author = self.result_dict['name']
@@ -530,11 +701,10 @@ class ScoreTool:
         self.narrator = None
         self.region = None
         self.title = None
-        return self.score_result()
 
-    def run_score_book(self):
+    def load_book(self):
         """
-            Scores a book result.
+            Loads the fields of a book result.
         """
         self.asin = self.result_dict['asin']
         self.authors_concat = ', '.join(
@@ -546,7 +716,6 @@ class ScoreTool:
         self.narrator = self.result_dict['narrator'][0]['name']
         self.region = self.result_dict['region']
         self.title = self.result_dict['title']
-        return self.score_result()
 
     def sum_scores(self, numberlist):
         """
@@ -596,18 +765,36 @@ class ScoreTool:
     def score_result(self):
         """
             Scores a result.
+            Returns the result dict, or None if the result is ignored.
+        """
+        # Subtract difference from initial score
+        # Subtract index to use Audible relevance as weight
+        score = (
+            self.INITIAL_SCORE -
+            self.sum_scores(self.score_deductions()) -
+            self.index
+        )
+        return self.score_finish_result(score)
+
+    def score_deductions(self):
+        """
+            Returns the list of score deductions for the loaded result.
         """
         # Array to hold score points for processing
         all_scores = []
+        # Deducting more than this puts the score below the ignore boundary
+        budget = self.INITIAL_SCORE - self.IGNORE_SCORE - self.index
 
         # Album name score
         if self.title:
-            title_score = self.score_album(self.title)
+            title_score = self.score_album(self.title, budget)
             if title_score:
                 all_scores.append(title_score)
-        # Author name score
-        if self.authors_concat:
-            author_score = self.score_author(self.authors_concat)
+        # Author name score, unless the result is already below the boundary
+        if self.authors_concat and self.sum_scores(all_scores) <= budget:
+            author_score = self.score_author(
+                self.authors_concat, budget - self.sum_scores(all_scores)
+            )
             if author_score:
                 all_scores.append(author_score)
         # Library language score
@@ -615,11 +802,13 @@ class ScoreTool:
             lang_score = self.score_language(self.language)
             if lang_score:
                 all_scores.append(lang_score)
+        return all_scores
 
-        # Subtract difference from initial score
-        # Subtract index to use Audible relevance as weight
-        score = self.INITIAL_SCORE - self.sum_scores(all_scores) - self.index
-
+    def score_finish_result(self, score):
+        """
+            Logs the final score of the loaded result,
+            and keeps it if it is above the ignore boundary.
+        """
         log.info("Result #" + str(self.index + 1))
 
         # Create result dict
@@ -627,40 +816,54 @@ class ScoreTool:
 
         if score >= self.IGNORE_SCORE:
             self.info.append(plex_score_dict)
-        else:
-            log.info(
-                '# Score is below ignore boundary (%s)... Skipping!',
-                self.IGNORE_SCORE
-            )
+            return plex_score_dict
+
+        log.info(
+            '# Score is below ignore boundary (%s)... Skipping!',
+            self.IGNORE_SCORE
+        )
+
+    def get_max_distance(self, budget, weight):
+        """
+            Converts a deduction budget into the largest edit distance
+            worth computing exactly, for a deduction of weight per edit.
+        """
+        if budget is None:
+            return None
+        return max(budget, 0) // weight
 
-    def score_album(self, title):
+    def score_album(self, title, budget=None):
         """
             Compare the input album similarity to the search result album.
-            Score is calculated with LevenshteinDistance
+            Score is calculated with LevenshteinDistance,
+            which stops early once the deduction exceeds the budget.
         """
-        scorebase1 = self.helper.media.album
+        scorebase1 = self.get_query_album()
         if not scorebase1:
             log.error('No album title found in file metadata')
             return 50
         scorebase2 = title.encode('utf-8')
         album_score = self.calculate_score(
-            self.reduce_string(scorebase1),
-            self.reduce_string(scorebase2)
+            scorebase1,
+            self.reduce_string(scorebase2),
+            self.get_max_distance(budget, 2)
         ) * 2
         log.debug("Score deduction from album: " + str(album_score))
         return album_score
 
-    def score_author(self, author):
+    def score_author(self, author, budget=None):
         """
             Compare the input author similarity to the search result author.
-            Score is calculated with LevenshteinDistance
+            Score is calculated with LevenshteinDistance,
+            which stops early once the deduction exceeds the budget.
         """
-        if self.helper.media.artist:
-            scorebase3 = self.helper.media.artist
+        scorebase3 = self.get_query_author()
+        if scorebase3:
             scorebase4 = author
             author_score = self.calculate_score(
-                self.reduce_string(scorebase3),
-                self.reduce_string(scorebase4)
+                scorebase3,
+                self.reduce_string(scorebase4),
+                self.get_max_distance(budget, 10)
             ) * 10
             log.debug("Score deduction from author: " + str(author_score))
             return author_score
@@ -673,21 +876,77 @@ class ScoreTool:
             Compare the library language to search results
             and knock off 2 points if they don't match.
         """
-        lang_dict = {
-            self.english_locale: 'English',
-            'de': 'German',
-            'es': 'Spanish',
-            'fr': 'French',
-            'it': 'Italian',
-            'ja': 'Japanese',
-        }
-
-        if language != lang_dict[self.helper.lang]:
+        library_language = self.get_library_language()
+        if language != library_language:
             log.debug(
                 'Audible language: %s; Library language: %s',
                 language,
-                lang_dict[self.helper.lang]
+                library_language
             )
             log.debug("Book is not library language, deduct 2 points")
             return 2
         return 0
+
+
+class BatchScoreTool(ScoreTool):
+    """
+        Scores a list of search results against the same query.
+        The query side (reduced album, author and library language)
+        is computed once, instead of once per result.
+        Results are passed as (index, result_dict, year) tuples.
+    """
+
+    def __init__(self, helper, locale, levenshtein_distance):
+        ScoreTool.__init__(
+            self, helper, 0, [], locale, levenshtein_distance, None
+        )
+        self.library_language = ScoreTool.get_library_language(self)
+        self.query_album = ScoreTool.get_query_album(self)
+        self.query_author = ScoreTool.get_query_author(self)
+
+    def get_library_language(self):
+        return self.library_language
+
+    def get_query_album(self):
+        return self.query_album
+
+    def get_query_author(self):
+        return self.query_author
+
+    def iter_scores(self, candidates):
+        """
+            Scores results one at a time,
+            yielding each one that scores above the ignore boundary.
+        """
+        for index, result_dict, year in candidates:
+            self.load_candidate(index, result_dict, year)
+            scored = self.score_result()
+
+            # Print separators for easy reading
+            log.separator(log_level="info")
+
+            if scored:
+                yield scored
+
+    def load_candidate(self, index, result_dict, year):
+        """
+            Loads a result into the scorer.
+        """
+        self.index = index
+        self.result_dict = result_dict
+        self.year = year
+        if self.helper.content_type == 'books':
+            self.load_book()
+        else:
+            self.load_author()
+
+    def score_all(self, candidates):
+        """
+            Scores all results,
+            and returns the kept ones ranked by score.
+        """
+        return sorted(
+            self.iter_scores(candidates),
+            key=lambda inf: inf['score'],
+            reverse=True
+        )
@@ -0,0 +1,356 @@
+import base64
+import hashlib
+import httplib
+import io
+import json
+import os
+import socket
+import threading
+import urlparse
+import zlib
+# Import internal tools
+from logging import Logging
+
+# Setup logger
+log = Logging()
+
+USER_AGENT = (
+    'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.2; Trident/4.0;'
+    'SLCC2; .NET CLR 2.0.50727; .NET CLR 3.5.30729; .NET CLR 3.0.30729;'
+    'Media Center PC 6.0'
+)
+
+
+class HTTPStatusError(Exception):
+    """
+        Raised when a response has an unsuccessful status code.
+    """
+
+    def __init__(self, response):
+        Exception.__init__(
+            self, 'HTTP ' + str(response.status) + ' for ' + response.url
+        )
+        self.response = response
+        self.status = response.status
+
+
+class Response:
+    """
+        A fully read HTTP response.
+
+        Parameters
+        ----------
+        url : str
+            The URL that produced the response, after redirects.
+        status : int
+            The HTTP status code.
+        headers : dict
+            Response headers, with lowercased names.
+        content : str
+            The decoded response body.
+    """
+
+    def __init__(self, url, status, headers, content):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    def __str__(self):
+        return self.content
+
+    def header(self, name, default=None):
+        """
+            Returns a response header by case-insensitive name.
+        """
+        return self.headers.get(name.lower(), default)
+
+    def raise_for_status(self):
+        """
+            Raises HTTPStatusError for 4xx and 5xx responses.
+        """
+        if self.status >= 400:
+            raise HTTPStatusError(self)
+
+
+class FixtureNotFoundError(Exception):
+    """
+        Raised when replaying a request that was never recorded.
+    """
+
+
+class Transport:
+    """
+        Interface for everything that sends HTTP requests.
+        All network I/O of the agent goes through the active transport,
+        see get_transport and set_transport.
+    """
+
+    def request(self, url, headers=None, timeout=None):
+        """
+            Makes a GET request and returns the Response.
+        """
+        raise NotImplementedError
+
+
+class PooledTransport(Transport):
+    """
+        HTTP transport which keeps connections alive and reuses them,
+        with a separate pool of idle connections per host.
+        Safe to share between threads; a connection is only ever
+        used by one request at a time.
+    """
+    # Idle connections kept around per host
+    MAX_IDLE_PER_HOST = 4
+    MAX_REDIRECTS = 5
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    TIMEOUT = 90
+
+    def __init__(self, headers=None):
+        self.headers = {
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+            'User-Agent': USER_AGENT,
+        }
+        if headers:
+            self.headers.update(headers)
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def acquire(self, scheme, host, timeout):
+        """
+            Returns an idle connection to the host,
+            or opens a new one if there are none.
+            The boolean tells whether the connection was reused.
+        """
+        with self.lock:
+            pool = self.pools.get((scheme, host))
+            if pool:
+                return pool.pop(), True
+        connection_class = (
+            httplib.HTTPSConnection if scheme == 'https'
+            else httplib.HTTPConnection
+        )
+        log.debug('Opening new connection to ' + host)
+        return connection_class(host, timeout=timeout), False
+
+    def close(self):
+        """
+            Closes all idle connections.
+        """
+        with self.lock:
+            pools = self.pools
+            self.pools = {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
+
+    def decode_content(self, body, headers):
+        """
+            Decompresses the body if the server gzipped it.
+        """
+        if headers.get('content-encoding') == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def release(self, scheme, host, connection):
+        """
+            Returns a connection to its host's idle pool.
+        """
+        with self.lock:
+            pool = self.pools.setdefault((scheme, host), [])
+            if len(pool) < self.MAX_IDLE_PER_HOST:
+                pool.append(connection)
+                return
+        connection.close()
+
+    def request(self, url, headers=None, timeout=None):
+        """
+            Makes a GET request and returns the Response.
+            Redirects are followed.
+        """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = self.send(url, headers, timeout or self.TIMEOUT)
+            location = response.header('location')
+            if response.status not in self.REDIRECT_STATUSES or not location:
+                return response
+            url = urlparse.urljoin(url, location)
+            log.debug('Following redirect to ' + url)
+        return response
+
+    def send(self, url, headers, timeout):
+        """
+            Sends a single GET request over a pooled connection.
+            A reused connection may have been closed by the server
+            while idle, so that case is retried once on a new one.
+        """
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+
+        while True:
+            connection, reused = self.acquire(
+                parsed.scheme, parsed.netloc, timeout
+            )
+            try:
+                connection.request('GET', path, headers=request_headers)
+                raw_response = connection.getresponse()
+                body = raw_response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            break
+
+        response_headers = dict(
+            (name.lower(), value)
+            for name, value in raw_response.getheaders()
+        )
+        if raw_response.will_close:
+            connection.close()
+        else:
+            self.release(parsed.scheme, parsed.netloc, connection)
+
+        return Response(
+            url,
+            raw_response.status,
+            response_headers,
+            self.decode_content(body, response_headers)
+        )
+
+
+class FixtureTool:
+    """
+        Reads and writes request/response pairs in a fixture directory.
+        Each pair is one JSON file, named after a hash of the URL
+        and the request headers that change the response.
+
+        Parameters
+        ----------
+        fixture_dir : str
+            Directory holding the fixture files.
+    """
+    # Request headers that change what the server sends back
+    VARYING_HEADERS = ('if-modified-since', 'if-none-match', 'range')
+
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+
+    def get_path(self, url, headers):
+        """
+            Returns the fixture file path for a request.
+        """
+        varying = sorted(
+            (name.lower(), value) for name, value in (headers or {}).items()
+            if name.lower() in self.VARYING_HEADERS
+        )
+        digest = hashlib.sha1(repr((url, varying))).hexdigest()
+        return os.path.join(self.fixture_dir, digest + '.json')
+
+    def load(self, url, headers):
+        """
+            Returns the recorded Response for a request, or None.
+        """
+        path = self.get_path(url, headers)
+        if not os.path.exists(path):
+            return None
+        with io.open(path, 'rb') as fixture_file:
+            fixture = json.load(fixture_file)
+        return Response(
+            fixture['url'],
+            fixture['status'],
+            fixture['headers'],
+            base64.b64decode(fixture['content'])
+        )
+
+    def save(self, url, headers, response):
+        """
+            Records the Response for a request.
+        """
+        if not os.path.isdir(self.fixture_dir):
+            os.makedirs(self.fixture_dir)
+        fixture = {
+            'request_headers': headers or {},
+            'url': url,
+            'status': response.status,
+            'headers': response.headers,
+            # Base64 so images survive the JSON round trip
+            'content': base64.b64encode(response.content),
+        }
+        with io.open(self.get_path(url, headers), 'wb') as fixture_file:
+            fixture_file.write(json.dumps(fixture, indent=2, sort_keys=True))
+
+
+class RecordingTransport(Transport):
+    """
+        Passes requests to another transport and records
+        every response in a fixture directory.
+    """
+
+    def __init__(self, fixture_dir, inner=None):
+        self.fixtures = FixtureTool(fixture_dir)
+        self.inner = inner or PooledTransport()
+
+    def request(self, url, headers=None, timeout=None):
+        response = self.inner.request(url, headers=headers, timeout=timeout)
+        self.fixtures.save(url, headers, response)
+        return response
+
+
+class ReplayTransport(Transport):
+    """
+        Serves recorded responses from a fixture directory,
+        without any network access.
+    """
+
+    def __init__(self, fixture_dir):
+        self.fixtures = FixtureTool(fixture_dir)
+
+    def request(self, url, headers=None, timeout=None):
+        response = self.fixtures.load(url, headers)
+        if response is None:
+            raise FixtureNotFoundError('No recorded response for ' + url)
+        return response
+
+
+def build_transport(mode=None, fixture_dir=None):
+    """
+        Builds a transport for the given mode:
+        'live' (default), 'record' or 'replay'.
+        Defaults come from the AUDNEXUS_TRANSPORT and
+        AUDNEXUS_FIXTURE_DIR environment variables.
+    """
+    mode = mode or os.environ.get('AUDNEXUS_TRANSPORT') or 'live'
+    fixture_dir = fixture_dir or os.environ.get(
+        'AUDNEXUS_FIXTURE_DIR', 'fixtures'
+    )
+    if mode == 'record':
+        return RecordingTransport(fixture_dir)
+    if mode == 'replay':
+        return ReplayTransport(fixture_dir)
+    return PooledTransport()
+
+
+def get_transport():
+    """
+        Returns the active transport.
+    """
+    return transport
+
+
+def set_transport(new_transport):
+    """
+        Replaces the active transport, e.g. with a ReplayTransport.
+    """
+    global transport
+    log.info('Using transport: ' + new_transport.__class__.__name__)
+    transport = new_transport
+
+
+# Shared by all search, item and image requests
+transport = build_transport()
@@ -1,16 +1,19 @@
 # Import internal tools
+from cache_tools import image_size_cache
+from html_tools import replace_html_special
+from image_tools import probe_image_size
 from logging import Logging
 from region_tools import RegionTool
 import re
-import struct
-import urllib
-import os
 
 # Setup logger
 log = Logging()
 
 
 class UpdateTool:
+    # Tag sets written by set_metadata_tags
+    TAG_SETS = ()
+
     def __init__(self, content_type, force, lang, media, metadata, prefs):
         self.content_type = content_type
         self.force = force
@@ -34,43 +37,24 @@ class UpdateTool:
         log.debug('Update URL: ' + update_url)
         return update_url
 
+    def build_cache_key(self):
+        """
+            Builds the response cache key for the API request.
+        """
+        return '/'.join(
+            [self.content_type, self.extract_asin_from_id(), self.region]
+        )
+
     def cleanup_html(self):
         """
             Cleans up HTML in either the description or synopsis.
         """
-        html_tags = '<[^<]+?>'
-
         # Clean up HTML in the description
         if self.content_type == 'authors':
-            # First handle special cases
-            self.description = self.replace_html_special(self.description)
-            self.description = re.sub(
-                html_tags, '', self.description)
+            self.description = replace_html_special(self.description)
         # Clean up HTML in the synopsis
         if self.content_type == 'books':
-            # First handle special cases
-            self.synopsis = self.replace_html_special(self.synopsis)
-            self.synopsis = re.sub(
-                html_tags, '', self.synopsis)
-
-    def replace_html_special(self, input_html):
-        """
-            Replaces HTML lists with a bullet point.
-            Replaces HTML paragraphs with a newline.
-            Replaces HTML line breaks with a newline.
-        """
-        return (
-            input_html.replace("<ul>", "")
-            .replace("</ul>", "\n")
-            .replace("<ol>", "")
-            .replace("</ol>", "\n")
-            .replace("<li>", " • ")
-            .replace("</li>", "\n")
-            .replace("<br />", "")
-            .replace("<p>", "")
-            .replace("</p>", "\n")
-            .strip()
-        )
+            self.synopsis = replace_html_special(self.synopsis)
 
     def collect_metadata_to_log(self):
         """
@@ -161,6 +145,34 @@ class UpdateTool:
         log.info('Preferred region: ' + region)
         return region
 
+    def resolve_thumb(self):
+        """
+            Sets the final poster URL, if that takes any requests.
+            May run in a background thread, so it must not touch metadata.
+        """
+        pass
+
+    def get_tag_snapshot(self):
+        """
+            Returns the current tags of the metadata, sorted by tag set.
+        """
+        return dict(
+            (name, sorted(getattr(self.metadata, name)))
+            for name in self.TAG_SETS
+        )
+
+    def is_metadata_intact(self, previous):
+        """
+            Checks if the metadata still has the title, poster
+            and tags a previous update gave it.
+        """
+        if not self.metadata.title:
+            return False
+        thumb = previous['thumb']
+        if thumb and thumb not in self.metadata.posters:
+            return False
+        return previous.get('tags') == self.get_tag_snapshot()
+
     def log_update_metadata(self):
         """
             Writes metadata information to log.
@@ -186,6 +198,8 @@ class UpdateTool:
 
 
 class AlbumUpdateTool(UpdateTool):
+    TAG_SETS = ('genres', 'moods', 'similar', 'styles')
+
     def parse_api_response(self, response):
         """
             Parses keys from API into helper variables if they exist.
@@ -298,22 +312,14 @@ class AlbumUpdateTool(UpdateTool):
         # Create tagger.
         tagger = TagTool(self, self.prefs)
 
-        # Clears moods if force (refresh) is true.
-        if self.force:
-            tagger.clear_moods()
-            tagger.clear_styles()
-
         # Genres.
-        tagger.add_genres()
+        tagger.write_tags(self.metadata.genres, tagger.get_genres())
         # Narrators.
-        tagger.add_narrators_to_styles()
-        # Authors.
-        if self.prefs['store_author_as_mood']:
-            tagger.add_authors_to_moods()
-        # Series.
-        tagger.add_series_to_moods()
+        tagger.write_tags(self.metadata.styles, tagger.get_narrator_styles())
+        # Authors and series.
+        tagger.write_tags(self.metadata.moods, tagger.get_moods())
         # Similar.
-        tagger.add_similar()
+        tagger.write_tags(self.metadata.similar, tagger.get_similar())
 
     def set_metadata_title(self):
         """
@@ -359,64 +365,60 @@ class AlbumUpdateTool(UpdateTool):
 
 
 class ArtistUpdateTool(UpdateTool):
-    def get_square_image(self, image_url):
+    TAG_SETS = ('genres', 'similar')
+
+    def build_square_image_url(self, image_url, width, height):
         """
-            Get square author photos from Audible
+            Builds the Audible URL of a square crop of an image.
 
             Crop each portrait photo to a square centered at the top,
             and crop each landscape photo to a square at the horizontal center
         """
-        try:
-            image_file_dl = urllib.urlopen(image_url)
-            image_file_dl_contents = image_file_dl.read()
-            image_file_dl.close()
-
-            image_file = os.tmpfile()
-            image_file.write(image_file_dl_contents)
-
-            image_file.seek(0)
-
-            head = image_file.read(24)
-            if len(head) != 24:
-                image_file.close()
-                return image_url
-
-            image_file.seek(0)  # Read 0xff next
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                image_file.seek(size, 1)
-                byte = image_file.read(1)
-                while ord(byte) == 0xff:
-                    byte = image_file.read(1)
-                ftype = ord(byte)
-                size = struct.unpack('>H', image_file.read(2))[0] - 2
-            # We are at a SOFn block
-            image_file.seek(1, 1)  # Skip `precision' byte.
-            height, width = struct.unpack('>HH', image_file.read(4))
-
-            image_file.close()
-
-            if (height > width):
-                # Return a portrait image centered at the top
-                w_str = str(width)
-                square_image_url = image_url.replace(
-                    '.jpg',
-                    '.__01_SX'+w_str+'_CR0,0,'+w_str+','+w_str+'__.jpg'
-                )
-                return square_image_url
-
-            if (width > height):
-                # Return a landscape image centered at the horizontal middle
-                h_str = str(height)
-                padding = str((width - height) / 2)
-                square_image_url = image_url.replace(
-                    '.jpg',
-                    '.__01_SY'+h_str+'_CR'+padding+',0,'+h_str+','+h_str+'__.jpg'
-                )
-                return square_image_url
+        if (height > width):
+            # Return a portrait image centered at the top
+            w_str = str(width)
+            square_image_url = image_url.replace(
+                '.jpg',
+                '.__01_SX'+w_str+'_CR0,0,'+w_str+','+w_str+'__.jpg'
+            )
+            return square_image_url
+
+        if (width > height):
+            # Return a landscape image centered at the horizontal middle
+            h_str = str(height)
+            padding = str((width - height) / 2)
+            square_image_url = image_url.replace(
+                '.jpg',
+                '.__01_SY'+h_str+'_CR'+padding+',0,'+h_str+','+h_str+'__.jpg'
+            )
+            return square_image_url
+
+        return image_url
+
+    def get_square_image(self, image_url):
+        """
+            Get square author photos from Audible.
+            Dimensions are cached, so known images aren't fetched again.
+        """
+        cached = image_size_cache.get(image_url)
+        if cached:
+            log.debug('Using cached image size for ' + image_url)
+            return cached['square_url']
 
-            return image_url
+        try:
+            width, height = probe_image_size(image_url)
+            square_image_url = self.build_square_image_url(
+                image_url, width, height
+            )
+            image_size_cache.set(
+                image_url,
+                {
+                    'height': height,
+                    'square_url': square_image_url,
+                    'width': width,
+                }
+            )
+            return square_image_url
 
         except Exception as err:
             log.separator(
@@ -441,9 +443,8 @@ class ArtistUpdateTool(UpdateTool):
         if 'name' in response:
             self.name = response['name']
         if 'image' in response:
-            squared_image = self.get_square_image(response['image'])
-            log.debug('Square image: ' + squared_image)
-            self.thumb = squared_image
+            # Squared later by resolve_thumb, while the metadata is set
+            self.image = response['image']
         if 'similar' in response:
             self.similar = response['similar']
 
@@ -461,9 +462,19 @@ class ArtistUpdateTool(UpdateTool):
         """
         self.date = None
         self.genres = None
+        self.image = ''
         self.similar = None
         self.thumb = ''
 
+    def resolve_thumb(self):
+        """
+            Sets the thumb to the square crop of the author image.
+        """
+        if self.image:
+            squared_image = self.get_square_image(self.image)
+            log.debug('Square image: ' + squared_image)
+            self.thumb = squared_image
+
     def set_metadata_sort_title(self):
         """
             Set sort title of artist
@@ -495,9 +506,9 @@ class ArtistUpdateTool(UpdateTool):
         # Create tagger.
         tagger = TagTool(self, self.prefs)
         # Genres.
-        tagger.add_genres()
+        tagger.write_tags(self.metadata.genres, tagger.get_genres())
         # Similar.
-        tagger.add_similar()
+        tagger.write_tags(self.metadata.similar, tagger.get_similar())
 
     def set_metadata_title(self):
         """
@@ -508,66 +519,84 @@ class ArtistUpdateTool(UpdateTool):
 
 
 class TagTool:
+    """
+        Works out the tags an item should have,
+        and writes only the differences to the Plex metadata.
+        The get_* methods return the desired tags,
+        or None to leave the existing tags alone.
+    """
+
     def __init__(self, helper, Prefs):
         self.helper = helper
         self.prefs = Prefs
 
-    def add_genres(self):
+    def get_genres(self):
         """
-            Add genre(s) to Plex where available and depending on preference.
+            Genre(s) where available and depending on preference.
         """
         if not self.prefs['keep_existing_genres'] and self.helper.genres:
             if not self.helper.metadata.genres or self.helper.force:
-                self.helper.metadata.genres.clear()
-                for genre in self.helper.genres:
-                    if genre['name']:
-                        self.helper.metadata.genres.add(genre['name'])
-
-    def add_narrators_to_styles(self):
-        """
-            Adds narrators to styles.
-        """
-        if not self.helper.metadata.styles or self.helper.force:
-            self.helper.metadata.styles.clear()
-            for narrator in self.helper.narrator:
-                self.helper.metadata.styles.add(narrator['name'].strip())
+                return [
+                    genre['name'] for genre in self.helper.genres
+                    if genre['name']
+                ]
 
-    def add_authors_to_moods(self):
+    def get_moods(self):
         """
-            Adds authors to moods, except for cases in contibutors list.
+            Authors, except for cases in contibutors list,
+            and book series', since collections are not supported.
+            A refresh (force) replaces the existing moods.
         """
-        contributor_regex = '.+?(?= -)'
-        if not self.helper.metadata.moods or self.helper.force:
+        moods = [] if self.helper.force else list(self.helper.metadata.moods)
+        if self.prefs['store_author_as_mood'] and not moods:
+            contributor_regex = '.+?(?= -)'
             # Loop through authors to check if it has contributor wording
             for author in self.helper.author:
                 if not re.match(contributor_regex, author['name']):
-                    self.helper.metadata.moods.add(author['name'].strip())
-
-    def add_series_to_moods(self):
-        """
-            Adds book series' to moods, since collections are not supported
-        """
+                    moods.append(author['name'].strip())
         if self.helper.series:
-            self.helper.metadata.moods.add("Series: " + self.helper.series)
+            moods.append("Series: " + self.helper.series)
         if self.helper.series2:
-            self.helper.metadata.moods.add("Series: " + self.helper.series2)
+            moods.append("Series: " + self.helper.series2)
+        return moods
 
-    def add_similar(self):
+    def get_narrator_styles(self):
         """
-            Adds similar items.
+            Narrators, unless there are styles already.
+            A refresh (force) replaces the existing styles.
         """
-        if self.helper.similar:
-            for item in self.helper.similar:
-                self.helper.metadata.similar.add(item['name'])
-
-    def clear_moods(self):
-        """
-            Clears moods.
-        """
-        self.helper.metadata.moods.clear()
+        if not self.helper.metadata.styles or self.helper.force:
+            return [
+                narrator['name'].strip() for narrator in self.helper.narrator
+            ]
 
-    def clear_styles(self):
+    def get_similar(self):
         """
-            Clears styles.
+            Similar items, added to the existing ones.
         """
-        self.helper.metadata.styles.clear()
+        if self.helper.similar:
+            return list(self.helper.metadata.similar) + [
+                item['name'] for item in self.helper.similar
+            ]
+
+    def write_tags(self, tags, desired):
+        """
+            Makes a Plex tag set match the desired tags,
+            removing and adding only the tags that differ.
+        """
+        if desired is None:
+            return
+        current = set(tags)
+        wanted = set(desired)
+        for tag in current - wanted:
+            tags.remove(tag)
+        added = set()
+        for tag in desired:
+            if tag not in current and tag not in added:
+                tags.add(tag)
+                added.add(tag)
+        if added or current - wanted:
+            log.debug(
+                'Tags changed: %s added, %s removed',
+                len(added), len(current - wanted)
+            )
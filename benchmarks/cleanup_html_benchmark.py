@@ -0,0 +1,87 @@
+# coding: utf-8
+"""
+    Compares replace_html_special, which now also decodes entities,
+    with the previous replaces + re.sub cleanup, on long author bios.
+
+    Run with Python 2.7 from the repository root:
+    python benchmarks/cleanup_html_benchmark.py
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'Contents', 'Code')
+)
+from html_tools import replace_html_special  # noqa: E402
+
+# Number of times each conversion runs per measurement
+RUNS = 200
+# Paragraphs in the generated bio
+PARAGRAPHS = (1, 10, 100)
+
+
+def old_cleanup_html(input_html):
+    """
+        The previous cleanup: chained replaces, then a tag strip.
+    """
+    html_tags = '<[^<]+?>'
+    replaced = (
+        input_html.replace(u"<ul>", u"")
+        .replace(u"</ul>", u"\n")
+        .replace(u"<ol>", u"")
+        .replace(u"</ol>", u"\n")
+        .replace(u"<li>", u" • ")
+        .replace(u"</li>", u"\n")
+        .replace(u"<br />", u"")
+        .replace(u"<p>", u"")
+        .replace(u"</p>", u"\n")
+        .strip()
+    )
+    return re.sub(html_tags, u'', replaced)
+
+
+def build_bio(paragraphs):
+    """
+        Builds an author bio shaped like the ones Audible returns.
+    """
+    paragraph = (
+        u'<p>Frank Herbert was born in Tacoma, Washington, and worked as a '
+        u'reporter &amp; editor for <b>several</b> West Coast newspapers '
+        u'before becoming a full-time writer. <i>Dune</i> won the Hugo '
+        u'&amp; Nebula awards.<br />His books include:</p>'
+        u'<ul><li>Dune</li><li>Dune Messiah</li>'
+        u'<li>Children of Dune</li></ul>'
+    )
+    return paragraph * paragraphs
+
+
+def measure(function, bio):
+    """
+        Returns the fastest time of a conversion, in milliseconds.
+    """
+    return min(timeit.repeat(
+        lambda: function(bio), number=RUNS, repeat=3
+    )) / RUNS * 1000
+
+
+def main():
+    print('%12s %10s %12s %12s %8s' % (
+        'paragraphs', 'entities', 'old (ms)', 'new (ms)', 'ratio'
+    ))
+    for paragraphs in PARAGRAPHS:
+        for entities in (False, True):
+            bio = build_bio(paragraphs)
+            if not entities:
+                bio = bio.replace(u'&amp;', u'and')
+            old = measure(old_cleanup_html, bio)
+            new = measure(replace_html_special, bio)
+            print('%12s %10s %12.4f %12.4f %7.2fx' % (
+                paragraphs, entities, old, new, old / new
+            ))
+
+
+if __name__ == '__main__':
+    main()